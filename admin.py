@@ -1,5 +1,5 @@
 import re
-from sqlite3 import IntegrityError
+from sqlite3 import Connection, IntegrityError
 from time import time
 from typing import cast
 
@@ -24,7 +24,7 @@ from telegram.ext import CommandHandler, ConversationHandler, MessageHandler
 from telegram.ext.filters import COMMAND, TEXT, ChatType, UpdateType
 
 from config import config
-from db import db, get_kv, set_kv
+from db import execute, execute_many, transaction, user_cache
 from filters import ADMIN, CONFIG_ADMIN, AdminCallbackQueryHandler, banned_admins, config_admins, db_admins
 from help import admin_commands, admin_help, special_groups_help, user_commands
 from initiatives import (
@@ -38,6 +38,7 @@ from initiatives import (
     set_initiative_alert,
     set_initiative_log,
 )
+from outbox import OutboxItem, deliver_outbox, outbox_send
 from polls import (
     NP_GROUP,
     NP_MENU,
@@ -53,8 +54,19 @@ from polls import (
     newpoll_start_election,
     poll_chooser,
 )
-from shared import GROUP_REGEX, admin_log, get_group_member_ids, get_group_member_users, update_menu
+from profiler import profiler
+from settings import settings
+from shared import (
+    GROUP_REGEX,
+    admin_log,
+    get_group_member_ids,
+    get_group_member_users,
+    membership,
+    presence_changed,
+    update_menu,
+)
 from typings import AppContext, PendingBroadcast, PollState
+from update_log import update_log
 from util import escape
 
 END = ConversationHandler.END
@@ -87,7 +99,7 @@ async def handle_chat_member(update: Update, context: AppContext):
         await chat.leave()
         return
     db_admins.add(chat.id)
-    set_kv("admin_groups", sorted(db_admins))
+    await settings.save("admin_groups")
     await handle_admin_start(update, context)
 
 
@@ -117,13 +129,12 @@ async def handle_grant(update: Update, context: AppContext, start=False):
             return
         db_admins.add(uid)
         banned_admins.discard(uid)
-        set_kv("admin_groups", sorted(db_admins))
-        set_kv("banned_admins", sorted(banned_admins))
+        await settings.save("admin_groups", "banned_admins")
         await chat.send_message(f"Granted admin rights to <code>{uid}</code>.", parse_mode=ParseMode.HTML)
         return
     if uid not in db_admins:
         db_admins.add(uid)
-        set_kv("admin_groups", sorted(db_admins))
+        await settings.save("admin_groups")
         await admin_log(
             f"(<code>{uid}</code>) received admin rights via {escape(chat.effective_name or 'unnamed chat')} ({chat.id}).",
             update,
@@ -144,15 +155,14 @@ async def handle_deny(update: Update, context: AppContext, start=False):
             return
         db_admins.discard(uid)
         banned_admins.add(uid)
-        set_kv("admin_groups", sorted(db_admins))
-        set_kv("banned_admins", sorted(banned_admins))
+        await settings.save("admin_groups", "banned_admins")
         await chat.send_message(f"Removed admin rights from <code>{uid}</code>.", parse_mode=ParseMode.HTML)
 
 
 async def set_admin_log(update: Update, context: AppContext):
     message = cast(Message, update.message)
     chat = cast(Chat, update.effective_chat)
-    current = get_kv("admin_log", config["admins"][0])
+    current = settings.admin_log or config["admins"][0]
     if chat.id == current:
         await message.reply_text("Admin actions are already logged here!")
     else:
@@ -161,7 +171,8 @@ async def set_admin_log(update: Update, context: AppContext):
             update,
             context,
         )
-        set_kv("admin_log", message.chat_id)
+        settings.admin_log = message.chat_id
+        await settings.save("admin_log")
         await message.reply_text("Admin actions will now be logged here.")
 
 
@@ -170,22 +181,28 @@ async def unassign_code_start(update: Update, context: AppContext):
     if not context.args:
         await message.reply_text("<b>Usage:</b> <code>/unassign_code CODE</code>", parse_mode=ParseMode.HTML)
         return END
-    with db:
-        cur = db.cursor()
-        code = context.args[0]
-        user = cur.execute("SELECT * FROM users WHERE passcode = ?", [code]).fetchone()
+    code = context.args[0]
+
+    def unassign(conn: Connection):
+        user = conn.execute("SELECT * FROM users WHERE passcode = ?", [code]).fetchone()
         if user is None:
-            await message.reply_text(f"No user found with code {escape(code)}!", parse_mode=ParseMode.HTML)
-            return END
+            return f"No user found with code {escape(code)}!", None
         if user["tgUserId"] is None:
-            await message.reply_text(f"Code {escape(code)} is already unassigned!", parse_mode=ParseMode.HTML)
-            return END
-        cur.execute(
+            return f"Code {escape(code)} is already unassigned!", None
+        conn.execute(
             "UPDATE users SET tgUserId=NULL, tgUsername=NULL, tgDisplayName=NULL, language=NULL, present=0 WHERE id = ?",
             [user["id"]],
         )
-        await message.reply_text(f"Unassigned code {escape(code)} from user.", parse_mode=ParseMode.HTML)
-        await admin_log(f"unassigned code {escape(code)} from user.", update, context, parse_mode=ParseMode.HTML)
+        return None, user
+
+    error, user = await transaction(unassign)
+    if error is not None:
+        await message.reply_text(error, parse_mode=ParseMode.HTML)
+        return END
+    user_cache.invalidate(user["id"], user["tgUserId"])
+    membership.set_present([user["id"]], False)
+    await message.reply_text(f"Unassigned code {escape(code)} from user.", parse_mode=ParseMode.HTML)
+    await admin_log(f"unassigned code {escape(code)} from user.", update, context, parse_mode=ParseMode.HTML)
     return END
 
 
@@ -214,7 +231,7 @@ async def uids_args(message, args: list[str], *, allow_groups=True):
                     parse_mode=ParseMode.HTML,
                 )
                 return None
-            members = get_group_member_ids(arg)
+            members = await get_group_member_ids(arg)
             if not members:
                 await message.reply_text(f"No members in group {escape(arg)}.", parse_mode=ParseMode.HTML)
                 return None
@@ -224,12 +241,13 @@ async def uids_args(message, args: list[str], *, allow_groups=True):
 
 async def group_list(update: Update, context: AppContext):
     message = cast(Message, update.effective_message)
-    groups = db.execute("SELECT `group`, COUNT(userId) AS `count` FROM groupMembers GROUP BY `group`").fetchall()
+    await membership.load()
+    groups = sorted(membership.groups.items())
     if not groups:
         await message.reply_text("No groups currently exist.")
     else:
         await message.reply_text(
-            "\n".join(f"<code>{escape(row['group'])}</code> ({row['count']} members)" for row in groups),
+            "\n".join(f"<code>{escape(group)}</code> ({len(members)} members)" for group, members in groups),
             parse_mode=ParseMode.HTML,
         )
     return END
@@ -242,15 +260,7 @@ async def group_view(update: Update, context: AppContext):
         return END
     group = await group_arg(message, context.args[0])
     if group:
-        members = db.execute(
-            """
-            SELECT users.*
-            FROM groupMembers
-            INNER JOIN users ON users.id = groupMembers.userId
-            WHERE groupMembers.`group` = ?
-            """,
-            [group],
-        ).fetchall()
+        members = await get_group_member_users(group)
         if not members:
             await message.reply_text(
                 f"No members currently in <code>{escape(group)}</code>.", parse_mode=ParseMode.HTML
@@ -275,19 +285,19 @@ async def group_add(update: Update, context: AppContext):
     uids = await uids_args(message, context.args[1:])
     if group and uids:
         try:
-            with db:
-                cur = db.cursor()
-                cur.executemany(
+            changed = (
+                await execute_many(
                     "INSERT OR IGNORE INTO groupMembers (`userId`, `group`) VALUES (?, ?)",
                     [[uid, group] for uid in uids],
                 )
-                changed = cur.rowcount
+            ).rowcount
         except IntegrityError:
             await message.reply_text(
                 "Some nonexistent user IDs. Check your IDs from the participant sheet.",
                 parse_mode=ParseMode.HTML,
             )
         else:
+            membership.add(group, uids)
             await message.reply_text(
                 f"Added {changed} users to <code>{escape(group)}</code>.", parse_mode=ParseMode.HTML
             )
@@ -306,17 +316,17 @@ async def group_remove(update: Update, context: AppContext):
     group = await group_arg(message, context.args[0])
     uids = await uids_args(message, context.args[1:])
     if group and uids:
-        with db:
-            cur = db.cursor()
-            cur.execute(
+        changed = (
+            await execute(
                 f"DELETE FROM groupMembers WHERE `group`=? AND userId IN ({', '.join('?' * len(uids))})",
                 [group, *uids],
             )
-            changed = cur.rowcount
-            await message.reply_text(
-                f"Removed {changed} users from <code>{escape(group)}</code>.", parse_mode=ParseMode.HTML
-            )
-            await admin_log(f"removed {changed} users from <code>{escape(group)}</code>.", update, context)
+        ).rowcount
+        membership.remove(group, uids)
+        await message.reply_text(
+            f"Removed {changed} users from <code>{escape(group)}</code>.", parse_mode=ParseMode.HTML
+        )
+        await admin_log(f"removed {changed} users from <code>{escape(group)}</code>.", update, context)
     return END
 
 
@@ -329,15 +339,15 @@ async def mark_absent(update: Update, context: AppContext):
         return END
     uids = await uids_args(message, context.args, allow_groups=False)
     if uids:
-        with db:
-            cur = db.cursor()
-            cur.execute(
+        changed = (
+            await execute(
                 f"UPDATE users SET present=0 WHERE present = 1 AND id IN ({', '.join('?' * len(uids))})",
                 uids,
             )
-            changed = cur.rowcount
-            await message.reply_text(f"Marked {changed} users as absent.", parse_mode=ParseMode.HTML)
-            await admin_log(f"marked {changed} users as absent.", update, context)
+        ).rowcount
+        presence_changed(uids, False)
+        await message.reply_text(f"Marked {changed} users as absent.", parse_mode=ParseMode.HTML)
+        await admin_log(f"marked {changed} users as absent.", update, context)
     return END
 
 
@@ -361,7 +371,7 @@ async def broadcast(update: Update, context: AppContext):
             parse_mode=ParseMode.HTML,
         )
         return END
-    target_count = len(get_group_member_ids(group))
+    target_count = len(await get_group_member_ids(group))
     if not target_count:
         await message.reply_text(
             f"No members in group {escape(group)}. (To send to everyone, use <code>/broadcast everyone ...</code>)",
@@ -402,23 +412,17 @@ async def broadcast(update: Update, context: AppContext):
 
 
 async def broadcast_message(group: str, text: str, entities: list[MessageEntity], context: AppContext):
-    targets = get_group_member_users(group)
-    attempted = 0
-    success = 0
+    targets = await get_group_member_users(group)
+    items: list[OutboxItem] = []
     skipped = 0
     for target in targets:
         if not (target["present"] and target["tgUserId"]):
             skipped += 1
             continue
-        attempted += 1
-        try:
-            await context.bot.send_message(target["tgUserId"], text, entities=entities)
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            success += 1
+        items.append(outbox_send(target["tgUserId"], text, entities=entities))
+    success = await deliver_outbox(context, f"broadcast to {group}", items)
     await admin_log(
-        f"Message sent successfully to {success} of {attempted} present users. {skipped} absent users skipped.",
+        f"Message sent successfully to {success} of {len(items)} present users. {skipped} absent users skipped.",
         None,
         context,
     )
@@ -453,6 +457,59 @@ async def broadcast_callback(update: Update, context: AppContext):
     return END
 
 
+async def db_stats(update: Update, context: AppContext):
+    message = cast(Message, update.effective_message)
+    if context.args and context.args[0] == "reset":
+        profiler.reset()
+        await message.reply_text("Query statistics reset.")
+        return END
+    stats = profiler.summary(10)
+    if not stats:
+        await message.reply_text("No queries recorded yet.")
+        return END
+    lines = []
+    for sql, query in stats:
+        if len(sql) > 150:
+            sql = sql[:150] + "..."
+        lines.append(
+            f"<code>{escape(sql)}</code>\n"
+            f"{query.count} runs, {query.total * 1000:.0f} ms total, "
+            f"{query.total / query.count * 1000:.1f} ms avg, {query.max * 1000:.1f} ms max"
+        )
+    await message.reply_text("\n\n".join(lines), parse_mode=ParseMode.HTML)
+    return END
+
+
+async def set_update_log(update: Update, context: AppContext):
+    message = cast(Message, update.effective_message)
+    if context.args:
+        if context.args[0] not in ("on", "off"):
+            await message.reply_text(
+                "<b>Usage:</b> <code>/update_log [on|off] [sample_rate] [field...]</code>", parse_mode=ParseMode.HTML
+            )
+            return END
+        update_log.enabled = context.args[0] == "on"
+        if len(context.args) > 1:
+            try:
+                rate = float(context.args[1])
+                if not 0 < rate <= 1:
+                    raise ValueError
+            except ValueError:
+                await message.reply_text("Sample rate must be a number over 0 and at most 1.")
+                return END
+            update_log.sample_rate = rate
+        if len(context.args) > 2:
+            update_log.fields = context.args[2:]
+        await admin_log(f"turned update logging {context.args[0]}.", update, context)
+    fields = ", ".join(update_log.fields) or "all"
+    await message.reply_text(
+        f"Update logging is {'on' if update_log.enabled else 'off'}, "
+        f"sample rate {update_log.sample_rate:g}, fields: {escape(fields)}.",
+        parse_mode=ParseMode.HTML,
+    )
+    return END
+
+
 admin_entry = [
     CommandHandler("start", handle_admin_start, ADMIN & ~UpdateType.EDITED),
     CommandHandler("grant", handle_grant, ADMIN & ~UpdateType.EDITED),
@@ -470,6 +527,8 @@ admin_entry = [
     CommandHandler("mark_absent", mark_absent, ADMIN & ~UpdateType.EDITED),
     CommandHandler("broadcast", broadcast, ADMIN & ~UpdateType.EDITED),
     CommandHandler("initiative_alert", set_initiative_alert, ADMIN & ~UpdateType.EDITED),
+    CommandHandler("db_stats", db_stats, ADMIN & ~UpdateType.EDITED),
+    CommandHandler("update_log", set_update_log, ADMIN & ~UpdateType.EDITED),
     AdminCallbackQueryHandler(newpoll_callback, pattern=r"^np_\w+:\d+$"),
     AdminCallbackQueryHandler(poll_chooser, pattern=r"^polls:\d+$"),
     AdminCallbackQueryHandler(broadcast_callback, pattern=r"^br_\w+:\d+$"),
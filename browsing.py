@@ -0,0 +1,122 @@
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+from heapq import heapify, heappop, heappush
+from typing import Any
+
+from db import DbInitiative, fetch_all, fetch_one, user_cache
+from typings import InitiativeState
+
+
+@dataclass
+class BrowseQueue:
+    """The approved initiatives a user hasn't signed, fewest passes first. Entries that no longer match passes or
+    the approved initiatives are dropped when they reach the top."""
+
+    passes: dict[int, int]
+    """Initiative ID -> times passed, -1 once signed"""
+    heap: list[tuple[int, int]] = field(default_factory=list)
+
+    def push(self, iid: int):
+        count = self.passes.get(iid, 0)
+        if count >= 0:
+            heappush(self.heap, (count, iid))
+
+
+async def with_creator(init: Any) -> DbInitiative:
+    """Adds the creator's current name, Telegram ID and language, like get_initiative does."""
+    user = user_cache.get(init["userId"])
+    if user is None:
+        generation = user_cache.generation
+        row = await fetch_one("SELECT * FROM users WHERE id = ?", [init["userId"]])
+        user = None if row is None else user_cache.put(row, generation)
+    return {
+        **init,
+        "userName": (user and user["name"]) or "<unknown user>",
+        "userTgId": user and user["tgUserId"],
+        "userLanguage": user and user["language"],
+    }
+
+
+class Browsing:
+    """In-memory browsing order for /initiatives: the approved initiatives with their rows, and a queue for each user
+    that has browsed them, loaded on first use. Anything that approves or closes an initiative, edits an approved one,
+    or records a pass or signature must call approve(), close(), update(), passed() or signed() afterwards."""
+
+    def __init__(self):
+        # initiatives.* only, the creator can change and is looked up when browsing
+        self.approved: dict[int, Any] = {}
+        self.queues: dict[int, BrowseQueue] = {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        # bumped on every change, so that a load that raced with one reads again
+        self.version = 0
+        self.user_versions: Counter[int] = Counter()
+
+    async def load(self):
+        if self.loaded:
+            return
+        async with self.lock:
+            while not self.loaded:
+                version = self.version
+                rows = await fetch_all("SELECT * FROM initiatives WHERE status = ?", [InitiativeState.approved])
+                if version == self.version:
+                    self.approved = {row["id"]: row for row in rows}
+                    self.loaded = True
+
+    async def queue(self, user_id: int) -> BrowseQueue:
+        await self.load()
+        queue = self.queues.get(user_id)
+        while queue is None:
+            version = self.user_versions[user_id]
+            rows = await fetch_all("SELECT initiativeId, passCount FROM initiativeChoices WHERE userId = ?", [user_id])
+            if version != self.user_versions[user_id]:
+                continue
+            queue = BrowseQueue({row["initiativeId"]: row["passCount"] for row in rows})
+            queue.heap = [(queue.passes.get(iid, 0), iid) for iid in self.approved if queue.passes.get(iid, 0) >= 0]
+            heapify(queue.heap)
+            queue = self.queues.setdefault(user_id, queue)
+        return queue
+
+    async def next(self, user_id: int) -> DbInitiative | None:
+        """The approved initiative the user hasn't signed and has passed the fewest times."""
+        queue = await self.queue(user_id)
+        while queue.heap:
+            count, iid = queue.heap[0]
+            if iid in self.approved and queue.passes.get(iid, 0) == count:
+                return await with_creator(self.approved[iid])
+            heappop(queue.heap)
+        return None
+
+    def approve(self, init: Any):
+        self.version += 1
+        if not self.loaded:
+            return
+        self.approved[init["id"]] = init
+        for queue in self.queues.values():
+            queue.push(init["id"])
+
+    def close(self, iid: int):
+        self.version += 1
+        self.approved.pop(iid, None)
+
+    def update(self, iid: int, **fields):
+        self.version += 1
+        if iid in self.approved:
+            self.approved[iid] = {**self.approved[iid], **fields}
+
+    def passed(self, user_id: int, iid: int):
+        self.user_versions[user_id] += 1
+        queue = self.queues.get(user_id)
+        if queue is not None and queue.passes.get(iid, 0) >= 0:
+            queue.passes[iid] = queue.passes.get(iid, 0) + 1
+            queue.push(iid)
+
+    def signed(self, user_id: int, iid: int):
+        self.user_versions[user_id] += 1
+        queue = self.queues.get(user_id)
+        if queue is not None:
+            queue.passes[iid] = -1
+
+
+browsing = Browsing()
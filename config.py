@@ -1,3 +1,4 @@
+import logging
 import tomllib
 from typing import TypedDict, cast
 
@@ -14,12 +15,187 @@ class InitiativesConfig(TypedDict):
     handle_cooldown: int
 
 
+class DeliveryConfig(TypedDict):
+    global_rate: float
+    chat_rate: float
+    workers: int
+    max_attempts: int
+    retry_base_delay: float
+    record_batch_rows: int
+    record_batch_delay: float
+
+
+class ProfilingConfig(TypedDict):
+    slow_query_ms: float
+
+
+class CacheConfig(TypedDict):
+    users: int
+
+
+class LiveResultsConfig(TypedDict):
+    interval: float
+
+
+class VotesConfig(TypedDict):
+    batch_rows: int
+    batch_delay: float
+
+
+class UpdatesConfig(TypedDict):
+    concurrency: int
+
+
+class WebhookConfig(TypedDict):
+    enabled: bool
+    listen: str
+    port: int
+    path: str
+    url: str
+    secret_token: str
+
+
+class PollingConfig(TypedDict):
+    timeout: int
+    read_timeout: float
+    connect_timeout: float
+    poll_interval: float
+
+
+class UpdateLogConfig(TypedDict):
+    enabled: bool
+    path: str
+    sample_rate: float
+    fields: list[str]
+    max_bytes: int
+    backups: int
+
+
+class ApiConfig(TypedDict):
+    base_url: str
+
+
+class FakeApiConfig(TypedDict):
+    listen: str
+    port: int
+    latency: float
+    jitter: float
+    error_rate: float
+    flood_rate: float
+    retry_after: int
+    global_rate: float
+    chat_rate: float
+
+
+class MetricsConfig(TypedDict):
+    enabled: bool
+    listen: str
+    port: int
+
+
+class PersistenceConfig(TypedDict):
+    interval: float
+
+
 class Config(TypedDict):
     token: str
     database: str
     admins: list[int]
     election: ElectionConfig
     initiatives: InitiativesConfig
+    delivery: DeliveryConfig
+    profiling: ProfilingConfig
+    cache: CacheConfig
+    live_results: LiveResultsConfig
+    votes: VotesConfig
+    updates: UpdatesConfig
+    webhook: WebhookConfig
+    polling: PollingConfig
+    update_log: UpdateLogConfig
+    api: ApiConfig
+    fake_api: FakeApiConfig
+    metrics: MetricsConfig
+    persistence: PersistenceConfig
+
 
+# sections that older config.toml files may not have
+defaults = {
+    "delivery": {
+        "global_rate": 25,
+        "chat_rate": 1,
+        "workers": 16,
+        "max_attempts": 5,
+        "retry_base_delay": 1,
+        "record_batch_rows": 100,
+        "record_batch_delay": 0.2,
+    },
+    "profiling": {
+        "slow_query_ms": 50,
+    },
+    "cache": {
+        "users": 2048,
+    },
+    "live_results": {
+        "interval": 5,
+    },
+    "votes": {
+        "batch_rows": 100,
+        "batch_delay": 0.05,
+    },
+    "updates": {
+        "concurrency": 32,
+    },
+    "webhook": {
+        "enabled": False,
+        "listen": "127.0.0.1",
+        "port": 8080,
+        "path": "/telegram",
+        "url": "",
+        "secret_token": "",
+    },
+    "polling": {
+        "timeout": 50,
+        "read_timeout": 5,
+        "connect_timeout": 5,
+        "poll_interval": 0,
+    },
+    "update_log": {
+        "enabled": False,
+        "path": "updates.jsonl",
+        "sample_rate": 1.0,
+        "fields": [],
+        "max_bytes": 10_000_000,
+        "backups": 5,
+    },
+    "api": {
+        "base_url": "https://api.telegram.org/bot",
+    },
+    "fake_api": {
+        "listen": "127.0.0.1",
+        "port": 8081,
+        "latency": 0.0,
+        "jitter": 0.0,
+        "error_rate": 0.0,
+        "flood_rate": 0.0,
+        "retry_after": 1,
+        "global_rate": 0,
+        "chat_rate": 0,
+    },
+    "metrics": {
+        "enabled": False,
+        "listen": "127.0.0.1",
+        "port": 9090,
+    },
+    "persistence": {
+        "interval": 10,
+    },
+}
 
 config = cast(Config, tomllib.load(open("config.toml", "rb")))
+for section, values in defaults.items():
+    cast(dict, config)[section] = {**values, **cast(dict, config).get(section, {})}
+
+# here rather than in main(), so that it's in place before db.py migrates the database on import
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+# httpx logs every Bot API request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -1,20 +1,37 @@
+import asyncio
 import json
 import sqlite3
-from typing import Any, cast, TypedDict, Literal
+from collections import OrderedDict
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+from threading import Thread, local
+from typing import Any, Callable, Generic, Iterable, NamedTuple, Sequence, TypeVar, cast, TypedDict, Literal
 
 from telegram import Update, User
 
 from config import config
+from profiler import ProfiledConnection
 from typings import PollState, InitiativeState
 
-db = sqlite3.connect(config["database"])
-db.row_factory = sqlite3.Row
+T = TypeVar("T")
 
-db.set_trace_callback(print)
+LOGGER = getLogger("dsitsibot.db")
 
-db.executescript(
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config["database"], check_same_thread=False, factory=ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    # these are per-connection, so every thread's connection needs them
+    conn.execute("PRAGMA foreign_keys = TRUE")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+_setup = connect()
+_setup.executescript(
     """
-PRAGMA foreign_keys = TRUE;
+PRAGMA journal_mode = WAL;
 
 CREATE TABLE IF NOT EXISTS kv (
     key CHAR(32) PRIMARY KEY,
@@ -94,9 +111,87 @@ CREATE TABLE IF NOT EXISTS sentMessages (
     status CHAR(8) NOT NULL,
     PRIMARY KEY (chatId, messageId)
 );
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    batch VARCHAR(255) NOT NULL,
+    method CHAR(8) NOT NULL,
+    chatId INTEGER NOT NULL,
+    messageId INTEGER DEFAULT NULL,
+    userId INTEGER DEFAULT NULL REFERENCES users (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    pollId INTEGER DEFAULT NULL REFERENCES polls (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    initiativeId INTEGER DEFAULT NULL REFERENCES initiatives (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    language CHAR(2) DEFAULT NULL,
+    payload TEXT NOT NULL,
+    status CHAR(8) NOT NULL DEFAULT 'pending',
+    createdAt DATETIME DEFAULT CURRENT_TIMESTAMP
+);
 """
 )
-db.commit()
+_setup.commit()
+
+# Schema changes on top of the tables above. PRAGMA user_version stores how many of these have been applied, so an
+# existing database is brought up to date at startup. Only ever append to this list.
+migrations: list[str] = [
+    # 1: indexes for the hot queries
+    """
+    CREATE INDEX IF NOT EXISTS usersByTgUser ON users (tgUserId);
+    CREATE INDEX IF NOT EXISTS groupMembersByGroup ON groupMembers (`group`, userId);
+    CREATE INDEX IF NOT EXISTS optionsByPoll ON options (pollId, orderNo);
+    CREATE INDEX IF NOT EXISTS votesByOption ON votes (pollId, optionId, area);
+    CREATE INDEX IF NOT EXISTS initiativesByStatus ON initiatives (status, createdAt);
+    CREATE INDEX IF NOT EXISTS initiativeChoicesByInitiative ON initiativeChoices (initiativeId, passCount);
+    CREATE INDEX IF NOT EXISTS sentMessagesByPoll ON sentMessages (pollId, isAdmin);
+    CREATE INDEX IF NOT EXISTS sentMessagesByChatPoll ON sentMessages (chatId, pollId);
+    CREATE INDEX IF NOT EXISTS sentMessagesByInitiative ON sentMessages (initiativeId, isAdmin);
+    CREATE INDEX IF NOT EXISTS sentMessagesByChatInitiative ON sentMessages (chatId, initiativeId);
+    CREATE INDEX IF NOT EXISTS outboxByStatus ON outbox (status, id);
+    """,
+    # 2: vote counts kept up to date by poll_callback
+    """
+    CREATE TABLE voteTallies (
+        pollId INTEGER NOT NULL REFERENCES polls (id) ON DELETE CASCADE ON UPDATE CASCADE,
+        optionId INTEGER NOT NULL REFERENCES options (id) ON DELETE CASCADE ON UPDATE CASCADE,
+        area VARCHAR(32) NOT NULL DEFAULT 'default',
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (pollId, optionId, area)
+    );
+    INSERT INTO voteTallies (pollId, optionId, area, count)
+    SELECT pollId, optionId, area, COUNT(*) FROM votes GROUP BY pollId, optionId, area;
+    """,
+    # 3: the sentMessages status an outbox message leaves behind once delivered
+    """
+    ALTER TABLE outbox ADD COLUMN sentStatus CHAR(8) DEFAULT NULL;
+    """,
+    # 4: user_data, bot_data and conversation states, one JSON row per user, bot_data field or conversation
+    """
+    CREATE TABLE persistence (
+        kind VARCHAR(64) NOT NULL,
+        key VARCHAR(64) NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID;
+    """,
+    # 5: signCount is now kept up to date on every signature, the creator's signature wasn't counted until the next one
+    """
+    UPDATE initiatives SET signCount = (
+        SELECT COUNT(*) FROM initiativeChoices WHERE initiativeId = initiatives.id AND passCount = -1
+    );
+    """,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    for number, script in enumerate(migrations[version:], version + 1):
+        LOGGER.info("Migrating database to version %d", number)
+        # executescript commits before running, so the transaction has to be part of the script
+        conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+
+
+try:
+    migrate(_setup)
+finally:
+    _setup.close()
 
 
 class DbUser(TypedDict):
@@ -141,16 +236,267 @@ class DbInitiative(TypedDict):
     signCount: int
 
 
-def get_kv(key: str, default: Any):
-    row = db.execute("SELECT value FROM kv WHERE key = ?", [key]).fetchone()
-    return json.loads(row[0]) if row else default
+class DbResult(NamedTuple):
+    rowcount: int
+    lastrowid: int | None
+
+
+def _resolve(future: asyncio.Future, result: Any = None, error: BaseException | None = None):
+    if future.done():
+        return  # awaiting task was cancelled
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class DbWriter(Thread):
+    """Owns the only writing connection. Jobs run one at a time, each in its own transaction, so writes are
+    serialized without blocking the event loop on fsync."""
+
+    def __init__(self):
+        super().__init__(name="db-writer", daemon=True)
+        self.jobs: SimpleQueue[tuple[Callable[[sqlite3.Connection], Any], asyncio.Future] | None] = SimpleQueue()
+
+    def run(self):
+        conn = connect()
+        while (job := self.jobs.get()) is not None:
+            func, future = job
+            loop = future.get_loop()
+            try:
+                with conn:
+                    result = func(conn)
+            except BaseException as err:
+                loop.call_soon_threadsafe(_resolve, future, None, err)
+            else:
+                loop.call_soon_threadsafe(_resolve, future, result)
+        conn.close()
+
+    def submit(self, func: Callable[[sqlite3.Connection], T]) -> "asyncio.Future[T]":
+        future = asyncio.get_running_loop().create_future()
+        self.jobs.put((func, future))
+        return future
+
+    def stop(self):
+        self.jobs.put(None)
+        self.join()
+
+
+writer = DbWriter()
+writer.start()
+
+# WAL mode lets these read while the writer is committing
+_readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-read")
+_reader_local = local()
+
+
+def _reader() -> sqlite3.Connection:
+    conn = getattr(_reader_local, "conn", None)
+    if conn is None:
+        conn = _reader_local.conn = connect()
+    return conn
+
+
+async def _read(func: Callable[[sqlite3.Connection], T]) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_readers, lambda: func(_reader()))
+
+
+async def fetch_one(sql: str, params: Sequence | dict = ()) -> Any:
+    return await _read(lambda conn: conn.execute(sql, params).fetchone())
+
+
+async def fetch_all(sql: str, params: Sequence | dict = ()) -> list[Any]:
+    return await _read(lambda conn: conn.execute(sql, params).fetchall())
+
+
+async def transaction(func: Callable[[sqlite3.Connection], T]) -> T:
+    """Runs func(conn) in the writer thread inside a single transaction. Use for read-modify-write sequences that
+    must not interleave with other writes."""
+    return await writer.submit(func)
+
+
+async def execute(sql: str, params: Sequence | dict = ()) -> DbResult:
+    def run(conn: sqlite3.Connection):
+        cur = conn.execute(sql, params)
+        return DbResult(cur.rowcount, cur.lastrowid)
+
+    return await transaction(run)
+
+
+async def execute_many(sql: str, seq_of_params: Iterable[Sequence | dict]) -> DbResult:
+    rows = list(seq_of_params)
+
+    def run(conn: sqlite3.Connection):
+        cur = conn.executemany(sql, rows)
+        return DbResult(cur.rowcount, cur.lastrowid)
+
+    return await transaction(run)
+
+
+class BatchWriter(Generic[T]):
+    """Buffers rows and writes them with write(conn, rows) in one transaction once max_rows rows have accumulated
+    or max_delay seconds have passed since the first one. Rows still buffered on a crash are lost, so await the
+    future from add() before acknowledging anything that must not be lost. write may return a list with a result for
+    each row, which the futures then resolve to instead of True."""
+
+    def __init__(self, write: Callable[[sqlite3.Connection, list[T]], Any], max_rows: int, max_delay: float):
+        self.write = write
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows: list[T] = []
+        self.waiting: list[asyncio.Future[Any]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.flushing: set[asyncio.Task] = set()
+        batch_writers.append(self)
+
+    def add(self, row: T) -> asyncio.Future[Any]:
+        """Returns a future that resolves to whether the row was written, or to its result from write."""
+        future = asyncio.get_running_loop().create_future()
+        self.rows.append(row)
+        self.waiting.append(future)
+        if len(self.rows) >= self.max_rows:
+            self.start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.start_flush)
+        return future
+
+    def start_flush(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        rows, self.rows = self.rows, []
+        waiting, self.waiting = self.waiting, []
+        if not rows:
+            return
+        try:
+            results = await transaction(lambda conn: self.write(conn, rows))
+            if results is None:
+                results = [True] * len(rows)
+        except Exception:
+            LOGGER.exception("Failed to write %d batched rows, retrying them one at a time", len(rows))
+            # so that one bad row doesn't take the rest of the batch with it
+            results = [await self.write_one(row) for row in rows]
+        for future, ok in zip(waiting, results):
+            if not future.done():
+                future.set_result(ok)
+
+    async def write_one(self, row: T) -> Any:
+        try:
+            results = await transaction(lambda conn: self.write(conn, [row]))
+            return True if results is None else results[0]
+        except Exception:
+            LOGGER.exception("Failed to write batched row %r", row)
+            return False
+
+    async def close(self):
+        await asyncio.gather(*self.flushing)
+        await self.flush()
+
+
+batch_writers: list[BatchWriter] = []
+
+
+async def close():
+    for batch_writer in batch_writers:
+        await batch_writer.close()
+    writer.stop()
+    _readers.shutdown()
+
+
+def load_all_kv() -> dict[str, Any]:
+    """Synchronously reads the whole kv table, for use at import time before the event loop is running."""
+    conn = connect()
+    try:
+        rows = conn.execute("SELECT key, value FROM kv").fetchall()
+    finally:
+        conn.close()
+    return {row["key"]: json.loads(row["value"]) for row in rows}
+
+
+class UserCache:
+    """LRU cache of users by ID and Telegram user ID, remembering unregistered Telegram users too. Everything that
+    writes to users must call update() or invalidate() after the write."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.by_id: OrderedDict[int, DbUser] = OrderedDict()
+        self.by_tg: OrderedDict[int, int | None] = OrderedDict()
+        # bumped on every change, so a read that raced with a write doesn't cache the old row
+        self.generation = 0
+
+    def get(self, user_id: int) -> DbUser | None:
+        user = self.by_id.get(user_id)
+        if user is not None:
+            self.by_id.move_to_end(user_id)
+        return user
+
+    def get_by_tg(self, tg_id: int) -> tuple[bool, DbUser | None]:
+        """Returns (found, user). A found None means the Telegram user isn't registered."""
+        if tg_id not in self.by_tg:
+            return False, None
+        self.by_tg.move_to_end(tg_id)
+        user_id = self.by_tg[tg_id]
+        if user_id is None:
+            return True, None
+        user = self.get(user_id)
+        return user is not None, user
+
+    def put(self, user: DbUser, generation: int) -> DbUser:
+        user = cast(DbUser, dict(user))
+        if generation != self.generation:
+            return user
+        self.by_id[user["id"]] = user
+        self.by_id.move_to_end(user["id"])
+        if user["tgUserId"] is not None:
+            self.by_tg[user["tgUserId"]] = user["id"]
+            self.by_tg.move_to_end(user["tgUserId"])
+        self.trim()
+        return user
+
+    def put_missing(self, tg_id: int, generation: int):
+        if generation != self.generation:
+            return
+        self.by_tg[tg_id] = None
+        self.trim()
+
+    def trim(self):
+        while len(self.by_id) > self.size:
+            self.by_id.popitem(last=False)
+        while len(self.by_tg) > self.size:
+            self.by_tg.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        self.generation += 1
+        user = self.by_id.get(user_id)
+        if user is not None:
+            self.by_id[user_id] = cast(DbUser, {**user, **fields})
+
+    def invalidate(self, user_id: int | None = None, tg_id: int | None = None):
+        self.generation += 1
+        if user_id is not None:
+            user = self.by_id.pop(user_id, None)
+            if user is not None and user["tgUserId"] is not None:
+                self.by_tg.pop(user["tgUserId"], None)
+        if tg_id is not None:
+            self.by_tg.pop(tg_id, None)
 
 
-def set_kv(key: str, value: Any):
-    with db:
-        db.execute("REPLACE INTO kv (key, value) VALUES (?, ?)", [key, json.dumps(value)])
+user_cache = UserCache(config["cache"]["users"])
 
 
-def get_user(update: Update) -> DbUser | None:
+async def get_user(update: Update) -> DbUser | None:
     tg_id = cast(User, update.effective_user).id
-    return db.execute("SELECT * FROM users WHERE tgUserId = ?", [tg_id]).fetchone()
+    found, user = user_cache.get_by_tg(tg_id)
+    if found:
+        return user
+    generation = user_cache.generation
+    user = await fetch_one("SELECT * FROM users WHERE tgUserId = ?", [tg_id])
+    if user is None:
+        user_cache.put_missing(tg_id, generation)
+        return None
+    return user_cache.put(user, generation)
@@ -0,0 +1,154 @@
+import asyncio
+from random import random
+from collections import deque
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config import config
+from metrics import DELIVERY_JOBS, DELIVERY_PENDING
+from typings import AppContext
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # the lock makes waiters take tokens in FIFO order
+        async with self.lock:
+            while (pause := self.paused_until - monotonic()) > 0:
+                await asyncio.sleep(pause)
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.capacity and self.paused_until <= monotonic() and not self.lock.locked()
+
+
+@dataclass
+class Job:
+    chat_id: int
+    call: Callable[[], Awaitable[Any]]
+    """Makes the API call"""
+    done: Callable[[Any], Awaitable[Any]] | None = None
+    """Called with the API call result on success"""
+    failed: Callable[[TelegramError], Awaitable[Any]] | None = None
+    """Called with the last error when the job is given up on"""
+    attempts: int = 0
+
+
+def retry_delay(err: TelegramError, attempts: int) -> float | None:
+    """How long to wait before retrying after err, or None if retrying won't help."""
+    if isinstance(err, RetryAfter):
+        return err.retry_after
+    # BadRequest is a NetworkError in PTB, but retrying it is pointless. 5xx responses and timeouts end up here.
+    if isinstance(err, NetworkError) and not isinstance(err, BadRequest):
+        base = config["delivery"]["retry_base_delay"]
+        return base * 2 ** (attempts - 1) * (1 + random())
+    return None
+
+
+class DeliveryEngine:
+    def __init__(self, global_rate: float, chat_rate: float, workers: int, max_attempts: int):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.workers = workers
+        self.max_attempts = max_attempts
+
+    def chat_bucket(self, chat_id: int):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, max(1.0, self.chat_rate))
+        return bucket
+
+    async def attempt(self, context: AppContext, job: Job) -> bool | None:
+        """Returns whether the job succeeded, or None if it should be requeued."""
+        lane = self.chat_bucket(job.chat_id)
+        await lane.acquire()
+        await self.global_bucket.acquire()
+        job.attempts += 1
+        try:
+            result = await job.call()
+        except TelegramError as err:
+            # edits to messages that already look right are fine
+            if "not modified" in str(err):
+                if job.done:
+                    await job.done(True)
+                return True
+            delay = retry_delay(err, job.attempts)
+            if delay is not None and job.attempts < self.max_attempts:
+                # the lane is paused rather than the worker, so other chats keep going meanwhile
+                lane.pause(delay)
+                # during a fan-out, flood control is usually the global limit, which the other chats would hit too
+                if isinstance(err, RetryAfter):
+                    self.global_bucket.pause(delay)
+                return None
+            await context.application.process_error(None, err)
+            if job.failed:
+                await job.failed(err)
+            return False
+        if job.done:
+            await job.done(result)
+        return True
+
+    async def run(self, context: AppContext, jobs: list[Job]) -> int:
+        queue = deque(jobs)
+        success = 0
+        DELIVERY_PENDING.inc(amount=len(jobs))
+
+        async def worker():
+            nonlocal success
+            while queue:
+                job = queue.popleft()
+                match await self.attempt(context, job):
+                    case None:
+                        queue.append(job)
+                        DELIVERY_JOBS.inc("retried")
+                    case True:
+                        success += 1
+                        DELIVERY_PENDING.dec()
+                        DELIVERY_JOBS.inc("sent")
+                    case False:
+                        DELIVERY_PENDING.dec()
+                        DELIVERY_JOBS.inc("failed")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(jobs)))))
+        # forget chats that have fully recovered, they'd get a fresh bucket anyway
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.full()]:
+            del self.chat_buckets[chat_id]
+        return success
+
+
+engine = DeliveryEngine(
+    config["delivery"]["global_rate"],
+    config["delivery"]["chat_rate"],
+    config["delivery"]["workers"],
+    config["delivery"]["max_attempts"],
+)
+
+
+async def deliver(context: AppContext, jobs: list[Job]) -> int:
+    """Runs jobs concurrently within Telegram's rate limits. Returns the number of successful jobs."""
+    return await engine.run(context, jobs)
@@ -0,0 +1,120 @@
+import asyncio
+import sys
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import (
+    BaseHandler,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    BaseUpdateProcessor,
+)
+
+
+def update_keys(update: object) -> list[tuple[str, int]]:
+    """The locks an update must hold, always user before chat so that two updates can't wait on each other."""
+    if not isinstance(update, Update):
+        return []
+    keys = []
+    if update.effective_user is not None:
+        keys.append(("user", update.effective_user.id))
+    # private chats have the same ID as the user
+    if update.effective_chat is not None and (
+        update.effective_user is None or update.effective_chat.id != update.effective_user.id
+    ):
+        keys.append(("chat", update.effective_chat.id))
+    return keys
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time and in arrival order for each user and each chat, which
+    ConversationHandler and user_data rely on."""
+
+    def __init__(self, concurrency: int):
+        # the base class limit would also count updates that are only waiting for the user's previous update, so a
+        # single busy user could fill it up; the real limit is applied once an update is free to run
+        super().__init__(sys.maxsize)
+        self.running = asyncio.BoundedSemaphore(concurrency)
+        self.locks: dict[tuple[str, int], asyncio.Lock] = {}
+        self.holders: dict[tuple[str, int], int] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: tuple[str, int]):
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        self.holders[key] = self.holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.holders[key]
+                del self.locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        async with AsyncExitStack() as stack:
+            for key in update_keys(update):
+                await stack.enter_async_context(self.lock(key))
+            async with self.running:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def child_handlers(conversation: ConversationHandler) -> list[BaseHandler]:
+    return [
+        *conversation.entry_points,
+        *(child for state in conversation.states.values() for child in state),
+        *conversation.fallbacks,
+    ]
+
+
+def handler_updates(handler: BaseHandler) -> set[str] | None:
+    """The update types a handler can act on, or None if that isn't known. Custom handlers can declare theirs in an
+    update_types attribute."""
+    declared = getattr(handler, "update_types", None)
+    if declared is not None:
+        return set(declared)
+    if isinstance(handler, ConversationHandler):
+        types: set[str] = set()
+        for child in child_handlers(handler):
+            child_types = handler_updates(child)
+            if child_types is None:
+                return None
+            types |= child_types
+        return types
+    if isinstance(handler, (CommandHandler, MessageHandler)):
+        # text inputs in conversations accept edits too
+        return {Update.MESSAGE, Update.EDITED_MESSAGE}
+    if isinstance(handler, CallbackQueryHandler):
+        return {Update.CALLBACK_QUERY}
+    if isinstance(handler, ChatMemberHandler):
+        return {
+            ChatMemberHandler.MY_CHAT_MEMBER: {Update.MY_CHAT_MEMBER},
+            ChatMemberHandler.CHAT_MEMBER: {Update.CHAT_MEMBER},
+        }.get(handler.chat_member_types, {Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER})
+    return None
+
+
+def allowed_updates(handlers: list[BaseHandler]) -> tuple[list[str], list[BaseHandler]]:
+    """Returns the update types to subscribe to for the handlers, and the handlers that made it fall back to all
+    types because their types aren't known."""
+    types: set[str] = set()
+    unknown = []
+    for handler in handlers:
+        handler_types = handler_updates(handler)
+        if handler_types is None:
+            unknown.append(handler)
+        else:
+            types |= handler_types
+    if unknown:
+        return list(Update.ALL_TYPES), unknown
+    return sorted(types), unknown
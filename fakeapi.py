@@ -0,0 +1,242 @@
+"""A local stand-in for the Bot API, for running the bot without Telegram.
+
+    python fakeapi.py [updates.jsonl]
+
+serves it on fake_api.listen:fake_api.port, handing out the given updates to getUpdates. Set api.base_url to
+http://<listen>:<port>/bot to point the bot at it. Latency, errors and flood control are set in [fake_api].
+"""
+import asyncio
+import json
+import sys
+from collections import Counter
+from itertools import count
+from math import ceil
+from random import random
+from time import time
+from typing import Any
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+from config import config
+from delivery import TokenBucket
+from httpserver import Handler, HttpServer, Request, Response
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int | None = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+    def to_dict(self) -> dict[str, Any]:
+        error: dict[str, Any] = {"ok": False, "error_code": self.code, "description": self.description}
+        if self.retry_after is not None:
+            error["parameters"] = {"retry_after": self.retry_after}
+        return error
+
+
+def take(bucket: TokenBucket) -> float:
+    """Takes a token if there is one, otherwise returns how many seconds until there is."""
+    bucket.refill()
+    if bucket.tokens < 1:
+        return (1 - bucket.tokens) / bucket.rate
+    bucket.tokens -= 1
+    return 0
+
+
+class FakeBotApi:
+    """Answers the methods the bot uses with plausible results, with the latency, errors and flood control set in
+    [fake_api]. Every call is counted, and recorded if record is set, so replays and load tests can check what the
+    bot would have sent."""
+
+    def __init__(self, record: bool = True):
+        settings = config["fake_api"]
+        self.latency = settings["latency"]
+        self.jitter = settings["jitter"]
+        self.error_rate = settings["error_rate"]
+        self.flood_rate = settings["flood_rate"]
+        self.retry_after = settings["retry_after"]
+        self.global_rate = settings["global_rate"]
+        self.chat_rate = settings["chat_rate"]
+        self.global_bucket = TokenBucket(self.global_rate, max(1.0, self.global_rate)) if self.global_rate else None
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.record = record
+        self.calls: list[tuple[str, dict[str, Any]]] = []
+        self.counts: Counter[str] = Counter()
+        self.errors: Counter[int] = Counter()
+        self.message_ids = count(1)
+        self.updates: list[dict[str, Any]] = []
+        self.new_updates = asyncio.Event()
+
+    def push_update(self, update: dict[str, Any]):
+        """Queues an update for getUpdates."""
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def message(self, params: dict[str, Any], message_id: int | None = None) -> dict[str, Any]:
+        chat_id = int(params.get("chat_id", 0))
+        message: dict[str, Any] = {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        # messages only carry inline keyboards
+        if isinstance(params.get("reply_markup"), dict) and "inline_keyboard" in params["reply_markup"]:
+            message["reply_markup"] = params["reply_markup"]
+        return message
+
+    def check_flood(self, params: dict[str, Any]):
+        wait = 0.0
+        if self.global_bucket is not None:
+            wait = take(self.global_bucket)
+        if not wait and self.chat_rate and "chat_id" in params:
+            chat_id = int(params["chat_id"])
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, max(1.0, self.chat_rate))
+            wait = take(bucket)
+        if wait:
+            raise ApiError(429, f"Too Many Requests: retry after {ceil(wait)}", ceil(wait))
+
+    async def call(self, method: str, params: dict[str, Any]) -> Any:
+        """Returns the result of a successful call, or raises ApiError."""
+        self.counts[method] += 1
+        if self.record:
+            self.calls.append((method, params))
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random() * self.jitter)
+        try:
+            if self.flood_rate and random() < self.flood_rate:
+                raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+            self.check_flood(params)
+            if self.error_rate and random() < self.error_rate:
+                raise ApiError(400, "Bad Request: injected error")
+        except ApiError as err:
+            self.errors[err.code] += 1
+            raise
+        match method:
+            case "getMe":
+                return BOT_USER
+            case "sendMessage":
+                return self.message(params)
+            case "editMessageText" | "editMessageReplyMarkup":
+                if "inline_message_id" in params:
+                    return True
+                return self.message(params, int(params["message_id"]))
+            case _:
+                return True
+
+    async def get_updates(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        # confirmed updates are forgotten, like Telegram does
+        offset = int(params.get("offset", 0))
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and params.get("timeout"):
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[: int(params.get("limit", 100))]
+
+    async def respond(self, method: str, params: dict[str, Any]) -> tuple[int, bytes]:
+        try:
+            result = {"ok": True, "result": await self.call(method, params)}
+            status = 200
+        except ApiError as err:
+            result = err.to_dict()
+            status = err.code
+        return status, json.dumps(result).encode()
+
+
+class FakeRequest(BaseRequest):
+    """Sends the bot's requests to a FakeBotApi in the same process."""
+
+    def __init__(self, api: FakeBotApi):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None, *args, **kwargs):
+        params = request_data.parameters if request_data is not None else {}
+        return await self.api.respond(url.rsplit("/", 1)[-1], params)
+
+
+def parse_params(request: Request) -> dict[str, Any]:
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return json.loads(request.body or b"{}")
+    params: dict[str, Any] = {}
+    # the bot sends form data, with everything that isn't a string JSON encoded
+    for name, value in parse_qsl(request.body.decode()):
+        if name == "text":
+            params[name] = value
+            continue
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+def error_response(err: ApiError) -> Response:
+    return Response(err.code, json.dumps(err.to_dict()).encode(), "application/json")
+
+
+def fake_api_handler(api: FakeBotApi) -> Handler:
+    async def handle(request: Request) -> Response:
+        if request.headers.get("content-type", "").startswith("multipart/"):
+            return error_response(ApiError(400, "Bad Request: file uploads are not supported"))
+        try:
+            params = parse_params(request)
+        except ValueError:
+            return error_response(ApiError(400, "Bad Request: invalid body"))
+        status, body = await api.respond(request.path.rsplit("/", 1)[-1], params)
+        return Response(status, body, "application/json")
+
+    return handle
+
+
+def fake_api_server(api: FakeBotApi) -> HttpServer:
+    # only the configured token is accepted, anything else is 404 like on Telegram
+    return HttpServer({f"/bot{config['token']}/": fake_api_handler(api)})
+
+
+async def serve(path: str | None):
+    api = FakeBotApi(record=False)
+    if path is not None:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    api.push_update(json.loads(line))
+    settings = config["fake_api"]
+    server = fake_api_server(api)
+    await server.start(settings["listen"], settings["port"])
+    print(f"Fake Bot API on http://{settings['listen']}:{settings['port']}/bot, {len(api.updates)} updates queued")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+        print("API calls: " + ", ".join(f"{method} {n}" for method, n in api.counts.most_common()))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(sys.argv[1] if len(sys.argv) > 1 else None))
+    except KeyboardInterrupt:
+        pass
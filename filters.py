@@ -3,12 +3,13 @@ from telegram.ext import CallbackQueryHandler
 from telegram.ext.filters import UpdateFilter
 
 from config import config
-from db import get_kv
+from settings import settings
 
 
 config_admins = set(config["admins"])
-db_admins = set(get_kv("admin_groups", []))
-banned_admins = set(get_kv("banned_admins", []))
+# live views, admin.py updates these in place
+db_admins = settings.admin_groups
+banned_admins = settings.banned_admins
 
 
 class AdminFilter(UpdateFilter):
@@ -49,6 +49,8 @@ admin_commands: list[tuple[str, str | None, str]] = [
     ("group_remove", "<from_group> <uid|group...>", "remove people from a group"),
     ("mark_absent", "<uid...>", "mark people as absent from the sitsit"),
     ("start_user", None, "register as a sitsi participant (only in private chat)"),
+    ("db_stats", "[reset]", "show the slowest database queries"),
+    ("update_log", "[on|off] [sample_rate] [field...]", "show or change logging of incoming updates"),
 ]
 
 special_groups_help = """Special group names:
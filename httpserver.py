@@ -0,0 +1,128 @@
+import asyncio
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from logging import getLogger
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+
+LOGGER = getLogger("dsitsibot.http")
+
+# idle keep-alive connections are closed after this many seconds
+IDLE_TIMEOUT = 60
+MAX_BODY = 1 << 20
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    query: str
+    headers: dict[str, str]
+    """Header names are lowercase"""
+    body: bytes
+
+
+@dataclass
+class Response:
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class BadRequest(Exception):
+    pass
+
+
+class HttpServer:
+    """A minimal HTTP/1.1 server for the few local endpoints the bot serves, so that no web framework is needed.
+    Routes are matched on the exact path, and a route ending in / also matches the paths directly under it."""
+
+    def __init__(self, routes: dict[str, Handler]):
+        self.routes = routes
+        self.server: asyncio.Server | None = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.connection, host, port)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), IDLE_TIMEOUT)
+                except BadRequest as err:
+                    await write_response(writer, Response(400, str(err).encode()), False)
+                    return
+                if request is None:
+                    return
+                response = await self.dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request: Request) -> Response:
+        handler = self.routes.get(request.path) or self.routes.get(request.path[: request.path.rfind("/") + 1])
+        if handler is None:
+            return Response(404, b"not found")
+        try:
+            return await handler(request)
+        except Exception:
+            LOGGER.exception("Error handling %s %s", request.method, request.path)
+            return Response(500, b"internal error")
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request | None:
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _version = line.decode("latin-1").split()
+    except ValueError:
+        raise BadRequest("malformed request line")
+    headers: dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, sep, value = line.decode("latin-1").partition(":")
+        if not sep:
+            raise BadRequest("malformed header")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise BadRequest("chunked bodies are not supported")
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise BadRequest("malformed content-length")
+    if not 0 <= length <= MAX_BODY:
+        raise BadRequest("body too large")
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    return Request(method.upper(), url.path, url.query, headers, body)
+
+
+async def write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+    reason = HTTPStatus(response.status).phrase
+    headers = {
+        "Content-Type": response.content_type,
+        "Content-Length": str(len(response.body)),
+        "Connection": "keep-alive" if keep_alive else "close",
+        **response.headers,
+    }
+    head = f"HTTP/1.1 {response.status} {reason}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+    writer.write(head.encode("latin-1") + b"\r\n" + response.body)
+    await writer.drain()
@@ -1,6 +1,8 @@
+import asyncio
 import re
 from datetime import datetime
 from math import ceil
+from sqlite3 import Connection
 from time import time
 from typing import cast
 
@@ -19,11 +21,23 @@ from telegram.constants import ParseMode
 from telegram.error import TelegramError
 from telegram.ext import ConversationHandler
 
+from browsing import browsing
 from config import config
-from db import DbInitiative, DbUser, db, get_kv, set_kv
+from db import DbInitiative, DbUser, execute, fetch_all, fetch_one, transaction, user_cache
 from langs import lang_icons, loc, locale
+from metrics import SIGNATURES
+from outbox import (
+    OutboxItem,
+    deliver_outbox,
+    outbox_edit,
+    outbox_send,
+    send_direct,
+    set_message_status,
+    set_messages_status,
+)
+from settings import settings
 from shared import admin_log, ignore_errors, log_errors, update_menu
-from typings import AppContext, InitiativeState, PendingInitiative
+from typings import AppContext, InitiativeState, MessageState, PendingInitiative
 from user_setup import require_setup
 from util import escape
 
@@ -36,16 +50,16 @@ IADM_MENU = "iadm_menu"
 END = ConversationHandler.END
 
 
-def initiative_create_allowed(user: DbUser, context: AppContext):
+async def initiative_create_allowed(user: DbUser, context: AppContext):
     if user["initiativeBanUntil"]:
         until = datetime.fromtimestamp(user["initiativeBanUntil"])
         if until > datetime.now():
             mins = ceil((until - datetime.now()).seconds / 60)
             return loc(context)["init_banned"].format(mins=mins)
-    existing = db.execute(
+    existing = await fetch_one(
         f"SELECT 1 FROM initiatives WHERE userId = ? AND status = '{InitiativeState.submitted}'",
         [user["id"]],
-    ).fetchone()
+    )
     if existing is not None:
         return loc(context)["init_in_review"]
     return None
@@ -54,7 +68,7 @@ def initiative_create_allowed(user: DbUser, context: AppContext):
 @require_setup
 async def handle_initiative(update: Update, context: AppContext, user: DbUser):
     message = cast(Message, update.effective_message)
-    reason = initiative_create_allowed(user, context)
+    reason = await initiative_create_allowed(user, context)
     if reason:
         await message.chat.send_message(reason)
         return END
@@ -155,12 +169,12 @@ async def initiative_callback(update: Update, context: AppContext, user: DbUser)
         return END
     match action:
         case "init_send":
-            reason = initiative_create_allowed(user, context)
+            reason = await initiative_create_allowed(user, context)
             if reason:
                 await callback_query.answer(reason, show_alert=True)
                 return INIT_CHECK
             await callback_query.answer()
-            iid = initiative_create(user, context.user_data.init_pending)
+            iid = await initiative_create(user, context.user_data.init_pending)
             await callback_query.edit_message_text(
                 loc(context)["init_sent"],
                 reply_markup=None,
@@ -203,19 +217,18 @@ async def initiative_callback(update: Update, context: AppContext, user: DbUser)
             return END
 
 
-def initiative_create(user: DbUser, data: PendingInitiative):
+async def initiative_create(user: DbUser, data: PendingInitiative):
     assert all(key in data for key in ("title", "desc"))
-    with db:
-        lang_suffix = cast(str, user["language"]).capitalize()
-        lang_cols = f"title{lang_suffix}, desc{lang_suffix}"
-        cur = db.cursor()
-        cur.execute(
+    lang_suffix = cast(str, user["language"]).capitalize()
+    lang_cols = f"title{lang_suffix}, desc{lang_suffix}"
+    iid = (
+        await execute(
             f"INSERT INTO initiatives (userId, {lang_cols}) VALUES (?, ?, ?)",
             [user["id"], data["title"], data["desc"]],
         )
-        iid = cur.lastrowid
-        assert iid
-        return iid
+    ).lastrowid
+    assert iid
+    return iid
 
 
 @require_setup
@@ -231,50 +244,44 @@ async def initiative_cancel(update: Update, context: AppContext, user: DbUser):
 @require_setup
 async def handle_initiatives(update: Update, context: AppContext, user: DbUser):
     tg_user = cast(User, update.effective_user)
-    # choose the 1) approved initiative 2) the user has not signed yet 3) and has passed the fewest times
-    chosen_init = db.execute(
-        f"""
-        SELECT initiatives.id, COALESCE(initiativeChoices.passCount, 0) AS realPassCount
-        FROM initiatives
-        LEFT JOIN initiativeChoices ON initiativeChoices.initiativeId = initiatives.id AND initiativeChoices.userId = ?
-        WHERE initiatives.status = '{InitiativeState.approved}' AND realPassCount >= 0
-        ORDER BY realPassCount ASC
-        LIMIT 1
-        """,
-        [user["id"]],
-    ).fetchone()
-    if not chosen_init:
+    # the approved initiative the user has not signed yet and has passed the fewest times
+    init = await browsing.next(user["id"])
+    if not init:
         msg = loc(context)["init_no_more"]
         if not user["initiativeNotifs"]:
             msg += loc(context)["init_no_more_notifs"]
         await tg_user.send_message(msg, parse_mode=ParseMode.HTML)
         return END
-    init = get_initiative(chosen_init["id"])
-    assert init
-    # delete existing messages
-    messages = db.execute(
-        f"SELECT messageId FROM sentMessages WHERE chatId = ? AND initiativeId = ? AND isAdmin = FALSE",
+    messages = await fetch_all(
+        f"SELECT messageId FROM sentMessages WHERE chatId = ? AND initiativeId = ? AND isAdmin = FALSE AND status != '{MessageState.deleted}'",
         [tg_user.id, init["id"]],
-    ).fetchall()
-    for db_msg in messages:
-        async with log_errors(context):
-            await context.bot.delete_message(chat_id=tg_user.id, message_id=db_msg["messageId"])
-        with db:
-            db.execute(
-                "DELETE FROM sentMessages WHERE chatId = ? AND messageId = ?",
-                [tg_user.id, db_msg["messageId"]],
-            )
+    )
     # send new message
     await send_initiative_users(context, init, user=user)
+    # the existing messages are deleted after answering, all at once
+    if messages:
+        context.application.create_task(
+            delete_user_messages(context, tg_user.id, [db_msg["messageId"] for db_msg in messages])
+        )
     return END
 
 
+async def delete_user_messages(context: AppContext, chat_id: int, message_ids: list[int]):
+    async def delete(message_id: int):
+        async with log_errors(context):
+            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+    await asyncio.gather(*(delete(message_id) for message_id in message_ids))
+    await set_messages_status(chat_id, message_ids, MessageState.deleted)
+
+
 @require_setup
 async def initiatives_callback(update: Update, context: AppContext, user: DbUser):
     callback_query = cast(CallbackQuery, update.callback_query)
+    message = cast(Message, callback_query.message)
     action, iid = (callback_query.data or "").split(":")
     iid = int(iid)
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     if not init:
         await callback_query.answer("Internal error - invalid initiative", show_alert=True)
         return END
@@ -292,12 +299,13 @@ async def initiatives_callback(update: Update, context: AppContext, user: DbUser
                 reply_markup=None,
                 parse_mode=ParseMode.HTML,
             )
+        await set_message_status(message.chat_id, message.message_id, MessageState.closed)
         return END
 
-    existing = db.execute(
+    existing = await fetch_one(
         "SELECT 1 FROM initiativeChoices WHERE userId = ? AND initiativeId = ? AND passCount < 0",
         [user["id"], init["id"]],
-    ).fetchone()
+    )
     if existing:
         voted = loc(context)["init_seconded"]
         await callback_query.answer(voted)
@@ -307,6 +315,7 @@ async def initiatives_callback(update: Update, context: AppContext, user: DbUser
                 reply_markup=None,
                 parse_mode=ParseMode.HTML,
             )
+        await set_message_status(message.chat_id, message.message_id, MessageState.voted)
         return END
 
     if init["status"] != InitiativeState.approved:
@@ -318,15 +327,15 @@ async def initiatives_callback(update: Update, context: AppContext, user: DbUser
     match action:
         case "inits_pass":
             await callback_query.answer()
-            with db:
-                db.execute(
-                    """
-                    INSERT INTO initiativeChoices (userId, initiativeId, passCount)
-                    VALUES (?, ?, 1)
-                    ON CONFLICT DO UPDATE SET passCount = passCount + 1 WHERE passCount > 0
-                    """,
-                    [user["id"], init["id"]],
-                )
+            await execute(
+                """
+                INSERT INTO initiativeChoices (userId, initiativeId, passCount)
+                VALUES (?, ?, 1)
+                ON CONFLICT DO UPDATE SET passCount = passCount + 1 WHERE passCount > 0
+                """,
+                [user["id"], init["id"]],
+            )
+            browsing.passed(user["id"], init["id"])
             return await handle_initiatives(update, context)
 
         case "inits_sign":
@@ -356,20 +365,39 @@ async def initiatives_callback(update: Update, context: AppContext, user: DbUser
         case "inits_sign2":
             voted = loc(context)["init_seconded"]
             await callback_query.answer(voted)
-            with db:
-                db.execute(
-                    "REPLACE INTO initiativeChoices (userId, initiativeId, passCount) VALUES (?, ?, -1)",
+
+            def sign(conn: Connection) -> tuple[bool, int]:
+                # only counts if the user hadn't signed already
+                signed = conn.execute(
+                    """
+                    INSERT INTO initiativeChoices (userId, initiativeId, passCount) VALUES (?, ?, -1)
+                    ON CONFLICT DO UPDATE SET passCount = -1 WHERE passCount != -1
+                    """,
                     [user["id"], init["id"]],
+                ).rowcount
+                if signed:
+                    new_count = conn.execute(
+                        "UPDATE initiatives SET signCount = signCount + 1 WHERE id = ? RETURNING signCount",
+                        [init["id"]],
+                    ).fetchone()["signCount"]
+                else:
+                    new_count = conn.execute(
+                        "SELECT signCount FROM initiatives WHERE id = ?", [init["id"]]
+                    ).fetchone()["signCount"]
+                conn.execute(
+                    "UPDATE sentMessages SET status=? WHERE chatId = ? AND messageId = ?",
+                    [MessageState.voted, message.chat_id, message.message_id],
                 )
-                new_count = db.execute(
-                    "SELECT COUNT(*) AS signCount FROM initiativeChoices WHERE initiativeId = ? AND passCount = -1",
-                    [init["id"]],
-                ).fetchone()["signCount"]
-                db.execute("UPDATE initiatives SET signCount = ? WHERE id = ?", [new_count, init["id"]])
-            # send alert if necessary
-            limits: list[int] = get_kv("initiative_alerts", config["initiatives"]["default_alerts"])
-            if any(init["signCount"] < limit <= new_count for limit in limits):
-                await send_initiative_admin(context, init, milestone=new_count)
+                return bool(signed), new_count
+
+            signed, new_count = await transaction(sign)
+            if signed:
+                browsing.signed(user["id"], init["id"])
+                browsing.update(init["id"], signCount=new_count)
+                SIGNATURES.inc()
+                # the count goes up by one, so reaching a threshold is crossing it
+                if new_count in settings.initiative_alerts:
+                    await send_initiative_admin(context, init, milestone=new_count)
             with ignore_errors(filter="not modified"):
                 await callback_query.edit_message_text(
                     initiative_users_text(init, lang, new=False, bottom=f"<b>{voted}</b>"),
@@ -391,11 +419,11 @@ async def initiatives_callback(update: Update, context: AppContext, user: DbUser
 @require_setup
 async def handle_inotifications(update: Update, context: AppContext, user: DbUser):
     new_setting = not user["initiativeNotifs"]
-    with db:
-        db.execute(
-            "UPDATE users SET initiativeNotifs=? WHERE id = ?",
-            [new_setting, user["id"]],
-        )
+    await execute(
+        "UPDATE users SET initiativeNotifs=? WHERE id = ?",
+        [new_setting, user["id"]],
+    )
+    user_cache.update(user["id"], initiativeNotifs=new_setting)
     await cast(Message, update.effective_message).chat.send_message(
         loc(context)["init_notifs_on" if new_setting else "init_notifs_off"],
         parse_mode=ParseMode.HTML,
@@ -419,7 +447,8 @@ async def set_initiative_alert(update: Update, context: AppContext):
             parse_mode=ParseMode.HTML,
         )
         return END
-    set_kv("initiative_alerts", alerts)
+    settings.initiative_alerts = alerts
+    await settings.save("initiative_alerts")
     await message.reply_text(
         f"Initiative alert limits set to {', '.join(map(str, alerts))}. Initiatives already over limits will not be alerted.",
         parse_mode=ParseMode.HTML,
@@ -431,9 +460,10 @@ async def set_initiative_alert(update: Update, context: AppContext):
 async def set_initiative_log(update: Update, context: AppContext):
     message = cast(Message, update.message)
     chat = cast(Chat, update.effective_chat)
-    current = get_kv("initiative_log", config["admins"][0])
+    current = settings.initiative_log
     if chat.id != current:
-        set_kv("initiative_log", chat.id)
+        settings.initiative_log = chat.id
+        await settings.save("initiative_log")
         await admin_log(
             f"moved initiative handling to {escape(chat.effective_name or 'unnamed')} ({chat.id}).",
             update,
@@ -490,8 +520,8 @@ async def iadm_save_title(update: Update, context: AppContext):
         return await iadm_ask_title(
             update, context, lang, prefix=f"<b>Maximum length is {config['initiatives']['title_max_len']}!</b>\n\n"
         )
-    with db:
-        db.execute(f"UPDATE initiatives SET title{lang.capitalize()}=? WHERE id = ?", [new_title, iid])
+    await execute(f"UPDATE initiatives SET title{lang.capitalize()}=? WHERE id = ?", [new_title, iid])
+    browsing.update(iid, **{f"title{lang.capitalize()}": new_title})
     return await iadm_main_menu(update, iid)
 
 
@@ -519,8 +549,8 @@ async def iadm_save_desc(update: Update, context: AppContext):
         return await iadm_ask_desc(
             update, context, lang, prefix=f"<b>Maximum length is {config['initiatives']['desc_max_len']}!</b>\n\n"
         )
-    with db:
-        db.execute(f"UPDATE initiatives SET desc{lang.capitalize()}=? WHERE id = ?", [new_desc, iid])
+    await execute(f"UPDATE initiatives SET desc{lang.capitalize()}=? WHERE id = ?", [new_desc, iid])
+    browsing.update(iid, **{f"desc{lang.capitalize()}": new_desc})
     return await iadm_main_menu(update, iid)
 
 
@@ -580,7 +610,7 @@ def iadm_menu_keyboard(init: DbInitiative, private=True, bot_link=""):
 
 
 async def iadm_main_menu(update: Update, iid: DbInitiative | int, *, top="", bottom=""):
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     if init is None:
         await update_menu(update, "Initiative not found!", reply_markup=None)
         return END
@@ -598,7 +628,7 @@ async def iadm_callback(update: Update, context: AppContext):
     iid = int(iid)
 
     # read data of initiative from db
-    init: DbInitiative | None = get_initiative(iid)
+    init: DbInitiative | None = await get_initiative(iid)
     if init is None:
         await callback_query.answer("Initiative not found!")
         await update_menu(update, "Initiative not found!", reply_markup=None)
@@ -646,14 +676,22 @@ async def iadm_callback(update: Update, context: AppContext):
             return END
         case "iadm_approve2":
             await callback_query.answer()
-            with db:
+
+            def approve(conn: Connection) -> bool:
                 # mark as approved
-                db.execute(f"UPDATE initiatives SET status='{InitiativeState.approved}' WHERE id = ?", [init["id"]])
+                conn.execute(f"UPDATE initiatives SET status='{InitiativeState.approved}' WHERE id = ?", [init["id"]])
                 # pre-sign by creator
-                db.execute(
+                presigned = conn.execute(
                     "INSERT OR IGNORE INTO initiativeChoices (userId, initiativeId, passCount) VALUES (?, ?, -1)",
                     [init["userId"], init["id"]],
-                )
+                ).rowcount
+                if presigned:
+                    conn.execute("UPDATE initiatives SET signCount = signCount + 1 WHERE id = ?", [init["id"]])
+                return bool(presigned)
+
+            if await transaction(approve):
+                browsing.signed(init["userId"], init["id"])
+            browsing.approve(await fetch_one("SELECT * FROM initiatives WHERE id = ?", [init["id"]]))
             # notify user
             if init["userTgId"]:
                 user_lang = init["userLanguage"] or "en"
@@ -691,8 +729,7 @@ async def iadm_callback(update: Update, context: AppContext):
         case "iadm_unconst2":
             await callback_query.answer("Marked as unconstitutional.")
             # mark as unconstitutional
-            with db:
-                db.execute(f"UPDATE initiatives SET status='{InitiativeState.unconst}' WHERE id = ?", [init["id"]])
+            await execute(f"UPDATE initiatives SET status='{InitiativeState.unconst}' WHERE id = ?", [init["id"]])
             # notify user
             if init["userTgId"]:
                 user_lang = init["userLanguage"] or "en"
@@ -727,18 +764,23 @@ async def iadm_callback(update: Update, context: AppContext):
             return END
         case "iadm_shitpost2":
             await callback_query.answer("Marked as shitpost.")
-            with db:
+
+            def shitpost(conn: Connection) -> int:
                 # mark as shitpost
-                db.execute(f"UPDATE initiatives SET status='{InitiativeState.shitpost}' WHERE id = ?", [init["id"]])
+                conn.execute(f"UPDATE initiatives SET status='{InitiativeState.shitpost}' WHERE id = ?", [init["id"]])
                 # ban user, length depends on shitpost count
-                user_shitposts = db.execute(
+                user_shitposts = conn.execute(
                     f"SELECT COUNT(*) AS count FROM initiatives WHERE userId = ? AND status = '{InitiativeState.shitpost}'",
                     [init["userId"]],
                 ).fetchone()["count"]
                 ban_idx = min(user_shitposts - 1, len(config["initiatives"]["shitpost_bans"]) - 1)
                 ban_length = config["initiatives"]["shitpost_bans"][ban_idx]
                 ban_ends = time() + ban_length * 60
-                db.execute(f"UPDATE users SET initiativeBanUntil=? WHERE id = ?", [ban_ends, init["userId"]])
+                conn.execute(f"UPDATE users SET initiativeBanUntil=? WHERE id = ?", [ban_ends, init["userId"]])
+                return ban_length
+
+            ban_length = await transaction(shitpost)
+            user_cache.invalidate(init["userId"])
             if init["userTgId"]:
                 user_lang = init["userLanguage"] or "en"
                 pref_title = (init["titleFi"], init["titleEn"])[:: 1 if user_lang == "fi" else -1]
@@ -779,9 +821,9 @@ async def iadm_callback(update: Update, context: AppContext):
             return END
         case "iadm_close2":
             await callback_query.answer("Signatures closed.")
-            with db:
-                # mark as closed
-                db.execute(f"UPDATE initiatives SET status='{InitiativeState.closed}' WHERE id = ?", [init["id"]])
+            # mark as closed
+            await execute(f"UPDATE initiatives SET status='{InitiativeState.closed}' WHERE id = ?", [init["id"]])
+            browsing.close(init["id"])
             # update menu
             init = {**init, "status": InitiativeState.closed}
             context.application.create_task(update_initiative_admin(context, init))
@@ -800,9 +842,9 @@ async def iadm_cancel(update: Update, context: AppContext):
         return await iadm_main_menu(update, pid)
 
 
-def get_initiative(init: int | DbInitiative) -> DbInitiative | None:
+async def get_initiative(init: int | DbInitiative) -> DbInitiative | None:
     if isinstance(init, int):
-        return db.execute(
+        return await fetch_one(
             """
             SELECT
                 initiatives.*,
@@ -814,7 +856,7 @@ def get_initiative(init: int | DbInitiative) -> DbInitiative | None:
             WHERE initiatives.id = ?
             """,
             [init],
-        ).fetchone()
+        )
     else:
         return init
 
@@ -822,43 +864,42 @@ def get_initiative(init: int | DbInitiative) -> DbInitiative | None:
 async def send_initiative_admin(
     context: AppContext, iid: int | DbInitiative, *, auto=False, target: int | None = None, milestone: int | None = None
 ):
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     if not init:
         raise RuntimeError("initiative not found")
     if auto:
         # don't auto-send if an unhandled initiative is still posted
-        existing = db.execute(
+        existing = await fetch_one(
             f"""
             SELECT 1
             FROM sentMessages
             INNER JOIN initiatives ON initiatives.id = sentMessages.initiativeId
             WHERE sentMessages.isAdmin = 1 AND initiatives.status = '{InitiativeState.submitted}'
             """
-        ).fetchone()
+        )
         if existing is not None:
             return
 
     # delete existing messages from groups (private messages will have menus -> don't touch)
     if milestone is not None:
-        messages = db.execute(
+        messages = await fetch_all(
             """
             SELECT chatId, messageId
             FROM sentMessages
             WHERE initiativeId = ? AND isAdmin = TRUE AND chatId < 0 -- XXX: not sure if this is 100% foolproof
             """,
             [init["id"]],
-        ).fetchall()
+        )
         for db_msg in messages:
             async with log_errors(context):
                 await context.bot.delete_message(chat_id=db_msg["chatId"], message_id=db_msg["messageId"])
-            with db:
-                db.execute(
-                    "DELETE FROM sentMessages WHERE chatId = ? AND messageId = ?",
-                    [db_msg["chatId"], db_msg["messageId"]],
-                )
+            await execute(
+                "DELETE FROM sentMessages WHERE chatId = ? AND messageId = ?",
+                [db_msg["chatId"], db_msg["messageId"]],
+            )
 
     # send new message
-    target = cast(int, target or get_kv("initiative_log", config["admins"][0]))
+    target = target or settings.initiative_log
     top = f"Initiative has {milestone} signatures!" if milestone is not None else ""
     msg = await context.bot.send_message(
         target,
@@ -870,29 +911,27 @@ async def send_initiative_admin(
             bot_link=context.bot.link,
         ),
     )
-    with db:
-        cur = db.cursor()
-        cur.execute(
-            "INSERT INTO sentMessages (chatId, messageId, initiativeId, language, isAdmin, status) VALUES (?, ?, ?, 'en', TRUE, 'open')",
-            [msg.chat_id, msg.message_id, init["id"]],
-        )
+    await execute(
+        "INSERT INTO sentMessages (chatId, messageId, initiativeId, language, isAdmin, status) VALUES (?, ?, ?, 'en', TRUE, 'open')",
+        [msg.chat_id, msg.message_id, init["id"]],
+    )
 
 
 async def send_next_initiative_admin(context: AppContext, *, auto: bool, target: int | None = None):
-    iid = db.execute(
+    iid = await fetch_one(
         f"SELECT id FROM initiatives WHERE status = '{InitiativeState.submitted}' ORDER BY createdAt ASC LIMIT 1"
-    ).fetchone()
+    )
     if iid is not None:
         async with log_errors(context):
             await send_initiative_admin(context, iid["id"], auto=auto, target=target)
 
 
 async def update_initiative_admin(context: AppContext, iid: int | DbInitiative):
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     assert init
-    messages = db.execute(
+    messages = await fetch_all(
         f"SELECT chatId, messageId FROM sentMessages WHERE initiativeId = ? AND isAdmin = TRUE", [init["id"]]
-    ).fetchall()
+    )
     text = iadm_menu_text(init)
     keyboards = {
         private: iadm_menu_keyboard(init, private=private, bot_link=context.bot.link) for private in (True, False)
@@ -930,14 +969,14 @@ def initiative_sign_keyboard(init: DbInitiative, lang: str):
 
 
 async def send_initiative_users(context: AppContext, iid: int | DbInitiative, *, user: DbUser | None = None):
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     assert init
     targets: list[DbUser]
     if user:
         targets = [user]
         langs = (cast(str, user["language"]),)
     else:
-        targets = db.execute(
+        targets = await fetch_all(
             """
             SELECT *
             FROM users
@@ -945,39 +984,34 @@ async def send_initiative_users(context: AppContext, iid: int | DbInitiative, *,
             WHERE initiativeNotifs = 1 AND passCount != -1
             """,
             [init["id"]],
-        ).fetchall()
+        )
         langs = ("fi", "en")
     messages = {lang: initiative_users_text(init, lang, not user) for lang in langs}
     keyboards = {lang: initiative_sign_keyboard(init, lang) for lang in langs}
-    attempted = 0
-    success = 0
+    items: list[OutboxItem] = []
     absent = 0
     for target in targets:
         if not target["tgUserId"] or not target["language"] or (not user and not target["present"]):
             absent += 1
             continue
         lang = cast(str, target["language"])
-        attempted += 1
-        try:
-            msg = await context.bot.send_message(
+        items.append(
+            outbox_send(
                 target["tgUserId"],
                 messages[lang],
+                user_id=target["id"],
+                initiative_id=init["id"],
+                lang=lang,
                 parse_mode=ParseMode.HTML,
                 reply_markup=keyboards[lang],
             )
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            with db:
-                cur = db.cursor()
-                cur.execute(
-                    "INSERT INTO sentMessages (chatId, messageId, userId, initiativeId, language, isAdmin, status) VALUES (?, ?, ?, ?, ?, FALSE, 'open')",
-                    [msg.chat_id, msg.message_id, target["id"], init["id"], lang],
-                )
-            success += 1
-    if not user:
+        )
+    if user:
+        await send_direct(context, items)
+    else:
+        success = await deliver_outbox(context, f"announcement of initiative {init['id']}", items)
         await admin_log(
-            f"Initiative <b>{escape(init['titleFi'])}</b> sent successfully to {success} of {attempted} present users. "
+            f"Initiative <b>{escape(init['titleFi'])}</b> sent successfully to {success} of {len(items)} present users. "
             f"{absent} absent users skipped.",
             None,
             context,
@@ -985,35 +1019,35 @@ async def send_initiative_users(context: AppContext, iid: int | DbInitiative, *,
 
 
 async def close_initiative(context: AppContext, iid: int | DbInitiative):
-    init = get_initiative(iid)
+    init = await get_initiative(iid)
     assert init
-    messages = db.execute(
-        f"SELECT chatId, messageId, language FROM sentMessages WHERE initiativeId = ? AND isAdmin = FALSE", [init["id"]]
-    ).fetchall()
-    success = 0
-    attempted = 0
+    # messages that already show the initiative as closed are left alone
+    messages = await fetch_all(
+        f"""
+        SELECT chatId, messageId, language
+        FROM sentMessages
+        WHERE initiativeId = ? AND isAdmin = FALSE AND status NOT IN ('{MessageState.closed}', '{MessageState.deleted}')
+        """,
+        [init["id"]],
+    )
     texts = {
         lang: initiative_users_text(init, lang, new=False, bottom=f"<b>{locale[lang]['init_closed']}</b>")
         for lang in ("fi", "en")
     }
-    for db_msg in messages:
-        lang = db_msg["language"]
-        attempted += 1
-        try:
-            with ignore_errors(filter="not modified"):
-                await context.bot.edit_message_text(
-                    texts[lang],
-                    chat_id=db_msg["chatId"],
-                    message_id=db_msg["messageId"],
-                    reply_markup=None,
-                    parse_mode=ParseMode.HTML,
-                )
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            success += 1
+    items = [
+        outbox_edit(
+            db_msg["chatId"],
+            db_msg["messageId"],
+            texts[db_msg["language"]],
+            status=MessageState.closed,
+            reply_markup=None,
+            parse_mode=ParseMode.HTML,
+        )
+        for db_msg in messages
+    ]
+    success = await deliver_outbox(context, f"closing of initiative {init['id']}", items)
     await admin_log(
-        f"Initiative <b>{escape(init['titleFi'])}</b> closed successfully in {success} of {attempted} messages.",
+        f"Initiative <b>{escape(init['titleFi'])}</b> closed successfully in {success} of {len(items)} messages.",
         None,
         context,
     )
@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from time import monotonic
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application
+
+from config import config
+from db import DbPoll, fetch_all
+from settings import settings
+from shared import ignore_errors, membership
+from typings import PollState
+from util import escape, grouplist
+
+# window for the voting rate, in seconds
+RATE_WINDOW = 60
+
+
+@dataclass
+class LiveResults:
+    poll: DbPoll
+    chat_id: int
+    message_id: int | None = None
+    dirty: bool = True
+    closed: bool = False
+    votes: deque[float] = field(default_factory=deque)
+    task: asyncio.Task | None = None
+
+
+live_results: dict[int, LiveResults] = {}
+
+
+def start_live_results(application: Application, poll: DbPoll):
+    """Posts a results message for an active poll to the admin log and keeps it updated until the poll closes. After
+    a restart, the message posted before it is edited instead."""
+    old = live_results.get(poll["id"])
+    if old is not None and not old.closed:
+        return
+    posted = settings.live_results.get(str(poll["id"]))
+    if posted is not None:
+        live = LiveResults(poll, posted[0], posted[1])
+    else:
+        live = LiveResults(poll, settings.admin_log or config["admins"][0])
+    live_results[poll["id"]] = live
+    # not application.create_task, Application.stop would wait for the loop to end
+    live.task = asyncio.create_task(run(application, live))
+
+
+def note_vote(poll_id: int):
+    live = live_results.get(poll_id)
+    if live is not None and not live.closed:
+        live.votes.append(monotonic())
+        live.dirty = True
+
+
+def stop_live_results(poll_id: int):
+    live = live_results.get(poll_id)
+    if live is not None:
+        live.closed = True
+        live.dirty = True
+
+
+async def resume_live_results(application: Application):
+    for poll in await fetch_all(f"SELECT * FROM polls WHERE status = '{PollState.active}'"):
+        start_live_results(application, poll)
+
+
+async def cancel_live_results():
+    tasks = [live.task for live in live_results.values() if live.task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    live_results.clear()
+
+
+async def run(application: Application, live: LiveResults):
+    # however many votes come in, the message is edited at most once per interval
+    interval = config["live_results"]["interval"]
+    while True:
+        if live.dirty:
+            live.dirty = False
+            try:
+                await publish(application, live)
+            except RetryAfter as err:
+                live.dirty = True
+                await asyncio.sleep(err.retry_after)
+                continue
+            except Exception as err:
+                await application.process_error(None, err)
+        if live.closed and not live.dirty:
+            if live_results.get(live.poll["id"]) is live:
+                del live_results[live.poll["id"]]
+            if settings.live_results.pop(str(live.poll["id"]), None) is not None:
+                await settings.save("live_results")
+            return
+        await asyncio.sleep(interval)
+
+
+async def publish(application: Application, live: LiveResults):
+    text = await render(live)
+    if live.message_id is not None:
+        try:
+            with ignore_errors(filter="not modified"):
+                await application.bot.edit_message_text(text, live.chat_id, live.message_id, parse_mode=ParseMode.HTML)
+            return
+        except BadRequest as err:
+            # deleted from the chat, post a new one
+            if "not found" not in str(err).lower():
+                raise
+    message = await application.bot.send_message(live.chat_id, text, parse_mode=ParseMode.HTML)
+    live.message_id = message.message_id
+    # remembered so that a restart edits this message instead of posting another
+    settings.live_results[str(live.poll["id"])] = [live.chat_id, live.message_id]
+    await settings.save("live_results")
+
+
+async def render(live: LiveResults) -> str:
+    poll = live.poll
+    if poll["perArea"]:
+        tallies = await fetch_all(
+            """
+            SELECT options.textFi, options.candidateId, voteTallies.area, voteTallies.count
+            FROM voteTallies
+            INNER JOIN options ON voteTallies.optionId = options.id
+            WHERE voteTallies.pollId = ?
+            ORDER BY voteTallies.area ASC, voteTallies.count DESC
+            """,
+            [poll["id"]],
+        )
+        by_area = grouplist(tallies, lambda row: row["area"])
+    else:
+        tallies = await fetch_all(
+            """
+            SELECT options.textFi, options.candidateId, SUM(voteTallies.count) AS count
+            FROM voteTallies
+            INNER JOIN options ON voteTallies.optionId = options.id
+            WHERE voteTallies.pollId = ?
+            GROUP BY voteTallies.optionId
+            ORDER BY count DESC
+            """,
+            [poll["id"]],
+        )
+        by_area = {None: tallies}
+    await membership.load()
+    # everyone who can vote, votes from voters who have left since still count
+    eligible = membership.members(poll["voterGroup"])
+    voters = len(eligible)
+    present = len(eligible & membership.present)
+    voted = sum(row["count"] for row in tallies)
+    now = monotonic()
+    while live.votes and live.votes[0] < now - RATE_WINDOW:
+        live.votes.popleft()
+
+    state = "Poll closed, final count." if live.closed else "Voting in progress."
+    result = f"<b>Live results</b>: {escape(poll['textFi'])}\n{state}\n\n"
+    result += f"Turnout: {voted} of {voters} voters"
+    if voters:
+        result += f" ({voted / voters:.0%})"
+    result += f", {present} present"
+    if not live.closed:
+        result += f"\nRate: {len(live.votes)} votes in the last minute"
+    for area, rows in by_area.items():
+        result += f"\n\n<b>Area {escape(area)}</b>:" if area is not None else "\n\n<b>Votes</b>:"
+        for row in rows:
+            result += "\n"
+            if row["candidateId"] is not None:
+                result += f"(UID <code>{row['candidateId']}</code>) "
+            result += f"{escape(row['textFi'])}: {row['count']} votes"
+        if not rows:
+            result += "\nNo votes."
+    if not by_area:
+        result += "\n\nNo votes."
+    result += f"\n\n<i>Updated {datetime.now():%H:%M:%S}</i>"
+    return result
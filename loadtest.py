@@ -0,0 +1,121 @@
+"""End-to-end load test against the fake Bot API over HTTP: announces a poll to simulated guests, then has every guest
+vote, and reports the fan-out and vote throughput.
+
+    python loadtest.py [--guests 1000] [--rate 1000]
+
+The guests and the poll are created in the database in config.toml, which must not have any users yet. The fake API
+is served on fake_api.listen:fake_api.port with the latency, errors and flood control set in [fake_api].
+"""
+import argparse
+import asyncio
+import sys
+from random import Random
+from sqlite3 import Connection
+from time import perf_counter
+
+from telegram import Update
+
+from config import config
+from db import fetch_all, fetch_one, transaction
+from delivery import TokenBucket, engine
+from fakeapi import FakeBotApi, fake_api_server
+from main import build_app
+from polls import send_poll
+from replay import Benchmark, running
+from shared import membership
+from typings import AppContext, PollState
+
+# Telegram user IDs of the guests start from here
+FIRST_TG_ID = 1_000_000
+
+
+async def create_guests(guests: int) -> tuple[int, list[int]]:
+    def write(conn: Connection) -> tuple[list[int], int, list[int]]:
+        conn.executemany(
+            "INSERT INTO users (passcode, tgUserId, name, present, language) VALUES (?, ?, ?, TRUE, ?)",
+            [(f"L{i:07d}", FIRST_TG_ID + i, f"Guest {i}", "fi" if i % 2 else "en") for i in range(guests)],
+        )
+        uids = [row["id"] for row in conn.execute("SELECT id FROM users")]
+        pid = conn.execute(
+            "INSERT INTO polls (textFi, textEn, status, perArea) VALUES (?, ?, ?, FALSE)",
+            ["Kuormatesti", "Load test", PollState.active],
+        ).lastrowid
+        oids = [
+            conn.execute(
+                "INSERT INTO options (pollId, textFi, textEn, orderNo) VALUES (?, ?, ?, ?)",
+                [pid, text, text, n],
+            ).lastrowid
+            for n, text in enumerate(["A", "B", "C"])
+        ]
+        return uids, pid, oids
+
+    uids, pid, oids = await transaction(write)
+    membership.add_users(uids)
+    return pid, oids
+
+
+async def load_test(guests: int, rate: float | None):
+    if (await fetch_one("SELECT COUNT(*) AS n FROM users"))["n"]:
+        sys.exit(f"{config['database']} already has users, run the load test on an empty database")
+    pid, oids = await create_guests(guests)
+    if rate is not None:
+        engine.global_bucket = TokenBucket(rate, max(1.0, rate))
+
+    api = FakeBotApi(record=False)
+    server = fake_api_server(api)
+    settings = config["fake_api"]
+    await server.start(settings["listen"], settings["port"])
+    config["api"]["base_url"] = f"http://{settings['listen']}:{settings['port']}/bot"
+    app = build_app()
+    benchmark = Benchmark(app)
+    try:
+        async with running(app):
+            start = perf_counter()
+            await send_poll(AppContext(app), pid)
+            fanout = perf_counter() - start
+            sent = await fetch_all("SELECT chatId, messageId FROM sentMessages WHERE pollId = ?", [pid])
+            print(f"Fan-out: {len(sent)} of {guests} delivered in {fanout:.2f} s, {len(sent) / fanout:.0f} messages/s")
+
+            random = Random(0)
+            updates = [
+                Update.de_json(
+                    {
+                        "update_id": n,
+                        "callback_query": {
+                            "id": str(n),
+                            "chat_instance": str(msg["chatId"]),
+                            "from": {"id": msg["chatId"], "is_bot": False, "first_name": "Guest"},
+                            "message": {
+                                "message_id": msg["messageId"],
+                                "date": 0,
+                                "chat": {"id": msg["chatId"], "type": "private"},
+                            },
+                            "data": f"vote_confirm:{random.choice(oids)}",
+                        },
+                    },
+                    app.bot,
+                )
+                for n, msg in enumerate(sent)
+            ]
+            elapsed = await benchmark.run([update for update in updates if update is not None])
+            votes = (await fetch_one("SELECT COUNT(*) AS n FROM votes WHERE pollId = ?", [pid]))["n"]
+            print(f"Votes: {votes} of {len(updates)} recorded in {elapsed:.2f} s, {len(updates) / elapsed:.0f} votes/s")
+    finally:
+        await server.close()
+    benchmark.report()
+    print(f"{benchmark.errors} errors")
+    print("API calls: " + ", ".join(f"{method} {n}" for method, n in api.counts.most_common()))
+    if api.errors:
+        print("Injected errors: " + ", ".join(f"{code} {n}" for code, n in api.errors.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against the fake Bot API.")
+    parser.add_argument("--guests", type=int, default=1000, help="number of guests to send the poll to")
+    parser.add_argument("--rate", type=float, help="override delivery.global_rate, in messages per second")
+    args = parser.parse_args()
+    asyncio.run(load_test(args.guests, args.rate))
+
+
+if __name__ == "__main__":
+    main()
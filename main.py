@@ -1,31 +1,32 @@
-import pprint
+import asyncio
 from logging import getLogger
 
-from telegram import Update
-from telegram.ext import Application, BaseHandler, ChatMemberHandler, ConversationHandler, ContextTypes, CallbackContext
+from telegram.ext import Application, ChatMemberHandler, ConversationHandler, ContextTypes
+from telegram.request import BaseRequest
 
 from admin import admin_entry, admin_states, handle_chat_member
+import db
 from config import config
+from dispatch import OrderedUpdateProcessor, allowed_updates
+from live_results import cancel_live_results, resume_live_results
+from metrics import ERRORS, MetricsRequest, instrument, metrics_server, start_metrics
+from outbox import resume_outbox
+from persistence import SqlitePersistence
 from shared import admin_log
+from update_log import UpdateLogHandler, update_log
 from user import user_entry, user_states
+from webhook import run_webhook
 from typings import AppContext, BotData, UserData
 
 
 LOGGER = getLogger("dsitsibot")
 
-
-class DumpHandler(BaseHandler):
-    def __init__(self):
-        super().__init__(self.handle, True)
-
-    async def handle(self, update: Update, _ctx):
-        pprint.pprint(update.to_dict(), width=120)
-
-    def check_update(self, _update):
-        return True
+# post_init runs before the application is running, so Application.stop doesn't know about these
+startup_tasks: list[asyncio.Task] = []
 
 
 async def log_error(update, context: AppContext):
+    ERRORS.inc(type(context.error).__name__)
     try:
         await admin_log(f"Error: {type(context.error).__name__}: {context.error}", None, context, parse_mode=None)
     except Exception:
@@ -33,10 +34,44 @@ async def log_error(update, context: AppContext):
     LOGGER.exception("Unhandled error", exc_info=context.error)
 
 
-def main():
+async def startup(app: Application):
+    update_log.start()
+    await start_metrics()
+    startup_tasks.append(asyncio.create_task(resume_outbox(app)))
+    startup_tasks.append(asyncio.create_task(resume_live_results(app)))
+
+
+async def shutdown(app: Application):
+    # whatever resume_outbox didn't deliver stays pending for the next start
+    for task in startup_tasks:
+        task.cancel()
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    startup_tasks.clear()
+    await cancel_live_results()
+    await metrics_server.close()
+    await db.close()
+    update_log.stop()
+
+
+def build_app(request: BaseRequest | None = None, get_updates_request: BaseRequest | None = None) -> Application:
+    """Builds the application with all handlers. The requests can be replaced to run the bot without Telegram."""
     context_types = ContextTypes(context=AppContext, user_data=UserData, bot_data=BotData)
-    app = Application.builder().context_types(context_types).token(config["token"]).build()
-    app.add_handler(DumpHandler(), -999)
+    builder = (
+        Application.builder()
+        .context_types(context_types)
+        .token(config["token"])
+        .base_url(config["api"]["base_url"])
+        .concurrent_updates(OrderedUpdateProcessor(config["updates"]["concurrency"]))
+        .persistence(SqlitePersistence(config["persistence"]["interval"]))
+        .post_init(startup)
+        .post_shutdown(shutdown)
+    )
+    # same pool size as the builder's default request
+    builder.request(request or MetricsRequest(connection_pool_size=256))
+    if get_updates_request is not None:
+        builder.get_updates_request(get_updates_request)
+    app = builder.build()
+    app.add_handler(UpdateLogHandler(), -999)
     app.add_handler(
         ConversationHandler(
             entry_points=[
@@ -50,13 +85,38 @@ def main():
             fallbacks=[],
             name="conversation",
             allow_reentry=True,
-            # persistent=True,
+            persistent=True,
         )
     )
     # app.add_handler()
     app.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
     app.add_error_handler(log_error)
-    app.run_polling()
+    for group in app.handlers.values():
+        for handler in group:
+            instrument(handler)
+    return app
+
+
+def main():
+    app = build_app()
+
+    update_types, unknown = allowed_updates([handler for group in app.handlers.values() for handler in group])
+    LOGGER.info("Subscribing to updates: %s", ", ".join(update_types))
+    if unknown:
+        LOGGER.info("Subscribing to all updates, types unknown for: %s", ", ".join(type(h).__name__ for h in unknown))
+    if config["webhook"]["enabled"]:
+        LOGGER.info("Receiving updates by webhook on %s:%d", config["webhook"]["listen"], config["webhook"]["port"])
+        run_webhook(app, update_types)
+    else:
+        polling = config["polling"]
+        LOGGER.info("Receiving updates by long polling, timeout %g s", polling["timeout"])
+        app.run_polling(
+            poll_interval=polling["poll_interval"],
+            timeout=polling["timeout"],
+            read_timeout=polling["read_timeout"],
+            connect_timeout=polling["connect_timeout"],
+            allowed_updates=update_types,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from functools import wraps
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+from telegram.ext import BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+from config import config
+from dispatch import child_handlers
+from httpserver import HttpServer, Request, Response
+
+LOGGER = getLogger("dsitsibot.metrics")
+
+PREFIX = "dsitsibot_"
+# seconds, from a cached DB read to a slow fan-out message
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A metric in the Prometheus text format. Label values are passed positionally, in the order of labels. Safe to
+    update from the DB threads."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.lock = Lock()
+        registry.append(self)
+
+    def lines(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.lines()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.labels, labels)} {value:g}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = BUCKETS
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # per label values: a count for each bucket and one for +Inf, then the sum
+        self.values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def lines(self):
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, labels, le)} {total:g}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {counts[-1]:g}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {total:g}"
+
+
+registry: list[Metric] = []
+
+HANDLER_SECONDS = Histogram("handler_seconds", "Time spent in update handlers.", ("handler",))
+DB_SECONDS = Histogram("db_statement_seconds", "Time spent in SQL statements, by statement type.", ("statement",))
+API_SECONDS = Histogram("api_request_seconds", "Time spent in Bot API requests.", ("method",))
+API_ERRORS = Counter("api_errors_total", "Failed Bot API requests, by HTTP status or exception.", ("method", "error"))
+DELIVERY_PENDING = Gauge("delivery_pending", "Messages waiting to be sent or retried by the delivery engine.")
+DELIVERY_JOBS = Counter("delivery_jobs_total", "Delivery attempts, by outcome.", ("result",))
+VOTES = Counter("votes_total", "Votes recorded.")
+SIGNATURES = Counter("signatures_total", "Initiative signatures recorded.")
+ERRORS = Counter("errors_total", "Errors that reached the error handler, by exception type.", ("type",))
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def instrument(handler: BaseHandler, seen: set[int] | None = None):
+    """Wraps the callbacks of handler, and of its children for conversations, to record their latency. Safe to call
+    again on handlers that are already wrapped."""
+    seen = set() if seen is None else seen
+    # the same handler can be in several conversation states
+    if id(handler) in seen:
+        return
+    seen.add(id(handler))
+    if isinstance(handler, ConversationHandler):
+        for child in child_handlers(handler):
+            instrument(child, seen)
+        return
+    callback = handler.callback
+    # the handlers are module-level, so building another application finds them already wrapped
+    if getattr(callback, "instrumented", False):
+        return
+    name = getattr(callback, "__qualname__", type(handler).__name__)
+
+    @wraps(callback)
+    async def timed(update, context):
+        start = perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_SECONDS.observe(perf_counter() - start, name)
+
+    timed.instrumented = True
+    handler.callback = timed
+
+
+class MetricsRequest(HTTPXRequest):
+    """Records the latency and errors of Bot API requests."""
+
+    async def do_request(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        start = perf_counter()
+        try:
+            code, payload = await super().do_request(url, *args, **kwargs)
+        except Exception as err:
+            API_ERRORS.inc(method, type(err).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(perf_counter() - start, method)
+        if code != 200:
+            API_ERRORS.inc(method, str(code))
+        return code, payload
+
+
+async def metrics_handler(request: Request) -> Response:
+    if request.method != "GET":
+        return Response(405, b"method not allowed")
+    return Response(200, render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+
+metrics_server = HttpServer({"/metrics": metrics_handler})
+
+
+async def start_metrics():
+    settings = config["metrics"]
+    if settings["enabled"]:
+        await metrics_server.start(settings["listen"], settings["port"])
+        LOGGER.info("Serving metrics on http://%s:%d/metrics", settings["listen"], settings["port"])
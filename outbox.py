@@ -0,0 +1,236 @@
+import json
+from functools import partial
+from sqlite3 import Connection
+from typing import Any, Literal, TypedDict
+
+from telegram import Bot, InlineKeyboardMarkup, Message, MessageEntity
+from telegram.error import TelegramError
+from telegram.ext import Application
+
+from config import config
+from db import BatchWriter, execute, execute_many, fetch_all, transaction
+from delivery import Job, deliver
+from shared import admin_log
+from typings import AppContext, MessageState
+from util import escape
+
+
+class OutboxItem(TypedDict):
+    method: Literal["send"] | Literal["edit"]
+    chatId: int
+    messageId: int | None
+    userId: int | None
+    pollId: int | None
+    initiativeId: int | None
+    language: str | None
+    payload: str
+    sentStatus: MessageState | None
+
+
+def encode_payload(text: str, api_kwargs: dict[str, Any]):
+    payload = {"text": text, **api_kwargs}
+    if payload.get("reply_markup") is not None:
+        payload["reply_markup"] = payload["reply_markup"].to_dict()
+    if payload.get("entities") is not None:
+        payload["entities"] = [entity.to_dict() for entity in payload["entities"]]
+    return json.dumps(payload)
+
+
+def decode_payload(payload: str, bot: Bot) -> dict[str, Any]:
+    api_kwargs = json.loads(payload)
+    if api_kwargs.get("reply_markup") is not None:
+        api_kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(api_kwargs["reply_markup"], bot)
+    if api_kwargs.get("entities") is not None:
+        api_kwargs["entities"] = [MessageEntity.de_json(entity, bot) for entity in api_kwargs["entities"]]
+    return api_kwargs
+
+
+def outbox_send(
+    chat_id: int,
+    text: str,
+    *,
+    user_id: int | None = None,
+    poll_id: int | None = None,
+    initiative_id: int | None = None,
+    lang: str | None = None,
+    status: MessageState = MessageState.open,
+    **api_kwargs,
+) -> OutboxItem:
+    """A message to send. Sends with a poll or initiative are recorded in sentMessages with the given status once
+    delivered."""
+    return {
+        "method": "send",
+        "chatId": chat_id,
+        "messageId": None,
+        "userId": user_id,
+        "pollId": poll_id,
+        "initiativeId": initiative_id,
+        "language": lang,
+        "payload": encode_payload(text, api_kwargs),
+        "sentStatus": status,
+    }
+
+
+def outbox_edit(
+    chat_id: int, message_id: int, text: str, *, status: MessageState | None = None, **api_kwargs
+) -> OutboxItem:
+    """An edit to a sent message. If status is given, the sentMessages row is updated to it once delivered."""
+    return {
+        "method": "edit",
+        "chatId": chat_id,
+        "messageId": message_id,
+        "userId": None,
+        "pollId": None,
+        "initiativeId": None,
+        "language": None,
+        "payload": encode_payload(text, api_kwargs),
+        "sentStatus": status,
+    }
+
+
+def write_sent(conn: Connection, done: list[tuple[Any, Message | bool]]):
+    """Records delivered sends with a poll or initiative in sentMessages, and the status of delivered edits."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO sentMessages (chatId, messageId, userId, pollId, initiativeId, language, isAdmin, status) VALUES (?, ?, ?, ?, ?, ?, FALSE, ?)",
+        [
+            [
+                msg.chat_id,
+                msg.message_id,
+                row["userId"],
+                row["pollId"],
+                row["initiativeId"],
+                row["language"],
+                row["sentStatus"] or MessageState.open,
+            ]
+            for row, msg in done
+            if isinstance(msg, Message) and (row["pollId"] is not None or row["initiativeId"] is not None)
+        ],
+    )
+    conn.executemany(
+        "UPDATE sentMessages SET status=? WHERE chatId = ? AND messageId = ?",
+        [
+            [row["sentStatus"], row["chatId"], row["messageId"]]
+            for row, _ in done
+            if row["method"] == "edit" and row["sentStatus"] is not None
+        ],
+    )
+
+
+def write_done(conn: Connection, done: list[tuple[Any, Message | bool]]):
+    conn.executemany("UPDATE outbox SET status='done' WHERE id = ?", [[row["id"]] for row, _ in done])
+    write_sent(conn, done)
+
+
+# one fsync per batch instead of one per recipient
+done_writer = BatchWriter(
+    write_done,
+    config["delivery"]["record_batch_rows"],
+    config["delivery"]["record_batch_delay"],
+)
+
+
+async def mark_done(row: Any, msg: Message | bool):
+    done_writer.add((row, msg))
+
+
+async def mark_failed(row: Any, err: TelegramError):
+    def write(conn: Connection):
+        conn.execute("UPDATE outbox SET status='failed' WHERE id = ?", [row["id"]])
+        # the user deleted the message, so there's nothing left to edit
+        if row["method"] == "edit" and "message to edit not found" in str(err).lower():
+            conn.execute(
+                f"UPDATE sentMessages SET status='{MessageState.deleted}' WHERE chatId = ? AND messageId = ?",
+                [row["chatId"], row["messageId"]],
+            )
+
+    await transaction(write)
+
+
+async def set_message_status(chat_id: int, message_id: int, status: MessageState):
+    await execute(
+        "UPDATE sentMessages SET status=? WHERE chatId = ? AND messageId = ?",
+        [status, chat_id, message_id],
+    )
+
+
+async def set_messages_status(chat_id: int, message_ids: list[int], status: MessageState):
+    await execute_many(
+        "UPDATE sentMessages SET status=? WHERE chatId = ? AND messageId = ?",
+        [[status, chat_id, message_id] for message_id in message_ids],
+    )
+
+
+async def call(bot: Bot, row: Any):
+    api_kwargs = decode_payload(row["payload"], bot)
+    if row["method"] == "send":
+        return await bot.send_message(row["chatId"], **api_kwargs)
+    return await bot.edit_message_text(chat_id=row["chatId"], message_id=row["messageId"], **api_kwargs)
+
+
+def outbox_job(context: AppContext, row: Any):
+    return Job(
+        row["chatId"],
+        partial(call, context.bot, row),
+        partial(mark_done, row),
+        partial(mark_failed, row),
+    )
+
+
+async def send_direct(context: AppContext, items: list[OutboxItem]) -> int:
+    """Sends replies to a user's own action right away, skipping the outbox and the delivery engine's rate limits,
+    which are for fan-outs. Returns the number delivered."""
+    done: list[tuple[Any, Message | bool]] = []
+    for item in items:
+        try:
+            done.append((item, await call(context.bot, item)))
+        except TelegramError as err:
+            await context.application.process_error(None, err)
+    if done:
+        await transaction(lambda conn: write_sent(conn, done))
+    return len(done)
+
+
+async def deliver_outbox(context: AppContext, batch: str, items: list[OutboxItem]) -> int:
+    """Stores items in the outbox in one transaction, then delivers them. Returns the number delivered."""
+
+    def enqueue(conn: Connection):
+        rows = []
+        for item in items:
+            row = {**item, "batch": batch}
+            row["id"] = conn.execute(
+                """
+                INSERT INTO outbox (
+                    batch, method, chatId, messageId, userId, pollId, initiativeId, language, payload, sentStatus
+                )
+                VALUES (
+                    :batch, :method, :chatId, :messageId, :userId, :pollId, :initiativeId, :language, :payload,
+                    :sentStatus
+                )
+                """,
+                row,
+            ).lastrowid
+            rows.append(row)
+        return rows
+
+    rows = await transaction(enqueue)
+    success = await deliver(context, [outbox_job(context, row) for row in rows])
+    # so that callbacks on the messages find them in sentMessages
+    await done_writer.flush()
+    return success
+
+
+async def resume_outbox(application: Application):
+    """Delivers whatever was left pending when the bot last stopped."""
+    context = AppContext(application)
+    await execute("DELETE FROM outbox WHERE status != 'pending'")
+    rows = await fetch_all("SELECT * FROM outbox WHERE status = 'pending' ORDER BY id ASC")
+    batches: dict[str, list[Any]] = {}
+    for row in rows:
+        batches.setdefault(row["batch"], []).append(row)
+    for batch, batch_rows in batches.items():
+        success = await deliver(context, [outbox_job(context, row) for row in batch_rows])
+        await admin_log(
+            f"Resumed {escape(batch)} after restart: {success} of {len(batch_rows)} pending messages delivered.",
+            None,
+            context,
+        )
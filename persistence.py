@@ -0,0 +1,138 @@
+import json
+from dataclasses import asdict, fields
+from sqlite3 import Connection
+from typing import Any
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import BatchWriter, fetch_all
+from typings import BotData, PendingBroadcast, UserData
+
+# a persistence run writes one row per changed user, all of them in one transaction
+BATCH_ROWS = 500
+BATCH_DELAY = 0.01
+
+USER = "user"
+BOT = "bot"
+
+
+def dump(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, sort_keys=True)
+
+
+DEFAULT_USER_DATA = dump(asdict(UserData()))
+
+
+def load_user_data(value: str) -> UserData:
+    data = json.loads(value)
+    # fields may have been removed since the row was written
+    known = {field.name for field in fields(UserData)}
+    data = {name: item for name, item in data.items() if name in known}
+    if data.get("broadcast_pending") is not None:
+        data["broadcast_pending"] = PendingBroadcast(**data["broadcast_pending"])
+    return UserData(**data)
+
+
+def load_bot_data(values: dict[str, str]) -> BotData:
+    data = BotData()
+    if "init_handlers" in values:
+        # JSON turns the int keys into strings and the tuples into lists
+        data.init_handlers = {int(iid): tuple(handler) for iid, handler in json.loads(values["init_handlers"]).items()}
+    return data
+
+
+def write_rows(conn: Connection, rows: list[tuple[str, str, str | None]]):
+    # the last write of a key wins, None deletes it
+    latest = {(kind, key): value for kind, key, value in rows}
+    conn.executemany(
+        "REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)",
+        [(kind, key, value) for (kind, key), value in latest.items() if value is not None],
+    )
+    conn.executemany(
+        "DELETE FROM persistence WHERE kind = ? AND key = ?",
+        [(kind, key) for (kind, key), value in latest.items() if value is None],
+    )
+
+
+class SqlitePersistence(BasePersistence[UserData, None, BotData]):
+    """Stores user_data, bot_data and conversation states in the persistence table. Application hands over every user
+    touched since the last run, so each entry is compared with what was last written and only the changed ones are
+    written."""
+
+    def __init__(self, update_interval: float):
+        super().__init__(PersistenceInput(chat_data=False, callback_data=False), update_interval)
+        # (kind, key) -> the JSON in the database
+        self.written: dict[tuple[str, str], str] = {}
+        self.writer = BatchWriter(write_rows, BATCH_ROWS, BATCH_DELAY)
+
+    async def load(self, kind: str) -> dict[str, str]:
+        rows = await fetch_all("SELECT key, value FROM persistence WHERE kind = ?", [kind])
+        values = {row["key"]: row["value"] for row in rows}
+        for key, value in values.items():
+            self.written[(kind, key)] = value
+        return values
+
+    async def store(self, kind: str, key: str, value: str | None):
+        if self.written.get((kind, key)) == value:
+            return
+        # on failure, written is left as is, so the entry is written again the next time it's handed over
+        if await self.writer.add((kind, key, value)):
+            if value is None:
+                self.written.pop((kind, key), None)
+            else:
+                self.written[(kind, key)] = value
+
+    async def get_user_data(self) -> dict[int, UserData]:
+        return {int(key): load_user_data(value) for key, value in (await self.load(USER)).items()}
+
+    async def update_user_data(self, user_id: int, data: UserData):
+        value = dump(asdict(data))
+        # most users never get past the defaults, Application creates those on demand anyway
+        await self.store(USER, str(user_id), None if value == DEFAULT_USER_DATA else value)
+
+    async def drop_user_data(self, user_id: int):
+        await self.store(USER, str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: UserData):
+        pass
+
+    async def get_bot_data(self) -> BotData:
+        return load_bot_data(await self.load(BOT))
+
+    async def update_bot_data(self, data: BotData):
+        # per field, so that a change in one doesn't rewrite the others
+        for field in fields(BotData):
+            await self.store(BOT, field.name, dump(getattr(data, field.name)))
+
+    async def refresh_bot_data(self, bot_data: BotData):
+        pass
+
+    async def get_conversations(self, name: str) -> dict[tuple[int | str, ...], object]:
+        values = await self.load(f"conversation:{name}")
+        return {tuple(json.loads(key)): json.loads(value) for key, value in values.items()}
+
+    async def update_conversation(self, name: str, key: tuple[int | str, ...], new_state: object | None):
+        await self.store(f"conversation:{name}", dump(list(key)), None if new_state is None else dump(new_state))
+
+    async def flush(self):
+        await self.writer.flush()
+
+    # chat_data and callback_data aren't used
+
+    async def get_chat_data(self) -> dict[int, None]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: None):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: None):
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any):
+        pass
@@ -1,6 +1,7 @@
 import re
 from collections import Counter
 from random import shuffle
+from sqlite3 import Connection
 from typing import cast
 
 from telegram import CallbackQuery, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
@@ -9,13 +10,24 @@ from telegram.error import TelegramError
 from telegram.ext import ConversationHandler
 
 from config import config
-from db import DbPoll, DbUser, db
+from db import DbPoll, DbUser, execute, fetch_all, fetch_one, transaction
 from help import special_groups_help
 from langs import lang_icons, loc, locale
-from shared import GROUP_REGEX, admin_log, get_group_member_users, ignore_errors, is_member, log_errors, update_menu
-from typings import AppContext, PendingPoll, PollState
+from live_results import start_live_results, stop_live_results
+from outbox import OutboxItem, deliver_outbox, outbox_edit, outbox_send, send_direct, set_message_status
+from shared import (
+    GROUP_REGEX,
+    admin_log,
+    get_group_member_users,
+    ignore_errors,
+    is_member,
+    log_errors,
+    update_menu,
+)
+from typings import AppContext, MessageState, PendingPoll, PollState
 from user_setup import require_setup
 from util import escape, grouplist
+from votes import VoteResult, forget_poll, get_vote_option, has_voted, record_vote
 
 NP_QUESTION = "np_question"
 NP_OPTIONS = "np_options"
@@ -61,7 +73,7 @@ async def newpoll_save_question(update: Update, context: AppContext):
         if lang == "en":
             if context.user_data.poll_is_election:
                 assert "textFi" in pending
-                pid = newpoll_create(pending, is_election=True)
+                pid = await newpoll_create(pending, is_election=True)
                 await admin_log(f"created the election <b>{escape(cast(str, pending['textFi']))}</b>.", update, context)
                 context.user_data.poll_pending = {}
                 return await newpoll_created(update, context, pid, is_election=True)
@@ -100,9 +112,7 @@ async def newpoll_save_options(update: Update, context: AppContext):
     if pid is not None and other_opts is None:
         other_opts = [
             opt[0]
-            for opt in db.execute(
-                f"SELECT text{other_lang.capitalize()} FROM options WHERE pollId = ?", [pid]
-            ).fetchall()
+            for opt in await fetch_all(f"SELECT text{other_lang.capitalize()} FROM options WHERE pollId = ?", [pid])
         ]
         pending["opts_en" if lang == "fi" else "opts_fi"] = other_opts
     # number of opts mismatch?
@@ -116,7 +126,7 @@ async def newpoll_save_options(update: Update, context: AppContext):
     else:
         # creating
         if other_opts is not None:
-            pid = newpoll_create(pending, is_election=False)
+            pid = await newpoll_create(pending, is_election=False)
             await admin_log(f"created the poll <b>{escape(cast(str, pending.get('textFi')))}</b>.", update, context)
             context.user_data.poll_pending = {}
             return await newpoll_created(update, context, pid, is_election=False)
@@ -166,7 +176,7 @@ async def newpoll_created(update: Update, context: AppContext, pid: int, *, is_e
     )
 
 
-def newpoll_create(pending: PendingPoll, *, is_election: bool):
+async def newpoll_create(pending: PendingPoll, *, is_election: bool):
     text_fi = pending.get("textFi")
     text_en = pending.get("textEn")
     assert text_fi and text_en
@@ -174,27 +184,28 @@ def newpoll_create(pending: PendingPoll, *, is_election: bool):
     opts_en = cast(list[str], pending.get("opts_en"))
     if not is_election:
         assert opts_fi and opts_en
-    with db:
-        cur = db.cursor()
-        cur.execute(
+
+    def create(conn: Connection):
+        pid = conn.execute(
             "INSERT INTO polls (type, perArea, textFi, textEn) VALUES (?, ?, ?, ?)",
             ["election" if is_election else "question", is_election, text_fi, text_en],
-        )
-        pid = cur.lastrowid
+        ).lastrowid
         assert pid
         if not is_election:
-            cur.executemany(
+            conn.executemany(
                 "INSERT INTO options (pollId, textFi, textEn, orderNo) VALUES (?, ?, ?, ?)",
                 [[pid, fi, en, num] for num, (fi, en) in enumerate(zip(opts_fi, opts_en))],
             )
-    return pid
+        return pid
+
+    return await transaction(create)
 
 
-def newpoll_commit(pid: int, is_election: bool, pending: PendingPoll):
+async def newpoll_commit(pid: int, is_election: bool, pending: PendingPoll):
     if not pending:
         return
-    with db:
-        cur = db.cursor()
+
+    def commit(conn: Connection):
         fields = ["updatedAt=CURRENT_TIMESTAMP"]
         values = []
         field_names = ["textFi", "textEn", "perArea", "voterGroup"]
@@ -205,15 +216,18 @@ def newpoll_commit(pid: int, is_election: bool, pending: PendingPoll):
                 fields.append(f"{field}=?")
                 values.append(pending[field])
 
-        cur.execute(f"UPDATE polls SET {', '.join(fields)} WHERE id=?", [*values, pid])
+        conn.execute(f"UPDATE polls SET {', '.join(fields)} WHERE id=?", [*values, pid])
         if (not is_election) and "opts_fi" in pending:
             assert "opts_en" in pending
-            cur.execute("DELETE FROM options WHERE pollId = ?", [pid])
-            cur.executemany(
+            conn.execute("DELETE FROM options WHERE pollId = ?", [pid])
+            conn.executemany(
                 "INSERT INTO options (pollId, textFi, textEn, orderNo) VALUES (?, ?, ?, ?)",
                 [[pid, fi, en, num] for num, (fi, en) in enumerate(zip(pending["opts_fi"], pending["opts_en"]))],
             )
 
+    await transaction(commit)
+    forget_rendering(pid)
+
 
 async def newpoll_cancel_ask(update: Update, context: AppContext):
     if (pid := context.user_data.poll_edit) is not None:
@@ -232,7 +246,7 @@ async def newpoll_cancel(update: Update, context: AppContext):
         return await newpoll_main_menu(update, context, pid, top="<b>Edits discarded.</b>")
 
 
-def newpoll_menu_text(poll: DbPoll, top=None, bottom=None, pending: PendingPoll = {}):
+async def newpoll_menu_text(poll: DbPoll, top=None, bottom=None, pending: PendingPoll = {}):
     is_election = poll["type"] == "election"
     merged = {**poll, **pending}
     text = f"{escape(merged['textFi'])}\n\n{escape(merged['textEn'])}\n\n"
@@ -241,9 +255,9 @@ def newpoll_menu_text(poll: DbPoll, top=None, bottom=None, pending: PendingPoll
             assert "opts_en" in pending
             opts = list(zip(pending["opts_fi"], pending["opts_en"]))
         else:
-            opts = db.execute(
+            opts = await fetch_all(
                 "SELECT textFi, textEn FROM options WHERE pollId = ? ORDER BY orderNo ASC", [poll["id"]]
-            ).fetchall()
+            )
         if not opts:
             text += "No options!"
         text += "\n".join(f"- {escape(fi)} / {escape(en)}" for fi, en in opts)
@@ -265,7 +279,7 @@ async def newpoll_callback(update: Update, context: AppContext):
     pid = int(pid)
 
     # read data of poll from db
-    poll: DbPoll | None = db.execute("SELECT * FROM polls WHERE id = ?", [pid]).fetchone()
+    poll: DbPoll | None = await fetch_one("SELECT * FROM polls WHERE id = ?", [pid])
     if poll is None:
         await callback_query.answer("Poll not found!")
         await update_menu(update, "Poll not found!", reply_markup=None)
@@ -330,7 +344,7 @@ async def newpoll_callback(update: Update, context: AppContext):
             return await newpoll_main_menu(update, context, pid, poll, top="<b>Edits discarded.</b>")
         case "np_commit":
             await callback_query.answer("Poll saved.")
-            newpoll_commit(pid, is_election, context.user_data.poll_pending)
+            await newpoll_commit(pid, is_election, context.user_data.poll_pending)
             await admin_log(f"edited the poll <b>{escape(poll['textFi'])}</b>.", update, context)
             context.user_data.poll_pending = {}
             return await newpoll_main_menu(update, context, pid, top="<b>Poll saved.</b>")
@@ -347,7 +361,7 @@ async def newpoll_callback(update: Update, context: AppContext):
             )
             await update_menu(
                 update,
-                newpoll_menu_text(poll, bottom=bottom),
+                await newpoll_menu_text(poll, bottom=bottom),
                 reply_markup=InlineKeyboardMarkup(
                     [
                         [InlineKeyboardButton("Yes, activate!", callback_data=f"np_activate2:{pid}")],
@@ -357,60 +371,67 @@ async def newpoll_callback(update: Update, context: AppContext):
             )
             return NP_MENU
         case "np_activate2":
-            with db:
-                if poll["status"] == PollState.created and is_election:
-                    # generate options
-                    db.execute("DELETE FROM options WHERE pollId = ?", [poll["id"]])
-                    candidates = get_group_member_users(poll["sourceGroup"])
-                    candidates = [cand for cand in candidates if cand["candidateNumber"]]
-                    if poll["perArea"]:
-                        voters = get_group_member_users(poll["voterGroup"])
-                        cand_areas = Counter(cand["area"] for cand in candidates)
-                        voter_areas = {voter["area"] for voter in voters}
-                        missing_areas = voter_areas - set(cand_areas)
-                        if missing_areas:
-                            await callback_query.answer(
-                                f"Some areas don't have candidates: " + ", ".join(missing_areas),
-                                show_alert=True,
-                            )
-                            return NP_MENU
-                        elif (max_cands := max(cand_areas.values())) > config["election"]["max_candidates"]:
-                            await callback_query.answer(
-                                f"There are too many candidates for an area: {max_cands} > {config['election']['max_candidates']}",
-                                show_alert=True,
-                            )
-                            return NP_MENU
-                    elif not candidates:
+            options = []
+            if poll["status"] == PollState.created and is_election:
+                # generate options
+                candidates = await get_group_member_users(poll["sourceGroup"])
+                candidates = [cand for cand in candidates if cand["candidateNumber"]]
+                if poll["perArea"]:
+                    voters = await get_group_member_users(poll["voterGroup"])
+                    cand_areas = Counter(cand["area"] for cand in candidates)
+                    voter_areas = {voter["area"] for voter in voters}
+                    missing_areas = voter_areas - set(cand_areas)
+                    if missing_areas:
                         await callback_query.answer(
-                            f"There are no candidates!",
+                            f"Some areas don't have candidates: " + ", ".join(missing_areas),
                             show_alert=True,
                         )
                         return NP_MENU
-                    elif len(candidates) > config["election"]["max_candidates"]:
+                    elif (max_cands := max(cand_areas.values())) > config["election"]["max_candidates"]:
                         await callback_query.answer(
-                            f"There are too many candidates: {len(candidates)} > {config['election']['max_candidates']}",
+                            f"There are too many candidates for an area: {max_cands} > {config['election']['max_candidates']}",
                             show_alert=True,
                         )
                         return NP_MENU
-                    candidates.sort(key=lambda cand: int(cast(str, cand["candidateNumber"])))
-                    options = [
-                        (
-                            cand["id"],
-                            cand["area"] if poll["perArea"] else None,
-                            f"{cand['candidateNumber']} {cand['name']}",
-                        )
-                        for cand in candidates
-                    ]
-                    db.executemany(
+                elif not candidates:
+                    await callback_query.answer(
+                        f"There are no candidates!",
+                        show_alert=True,
+                    )
+                    return NP_MENU
+                elif len(candidates) > config["election"]["max_candidates"]:
+                    await callback_query.answer(
+                        f"There are too many candidates: {len(candidates)} > {config['election']['max_candidates']}",
+                        show_alert=True,
+                    )
+                    return NP_MENU
+                candidates.sort(key=lambda cand: int(cast(str, cand["candidateNumber"])))
+                options = [
+                    (
+                        cand["id"],
+                        cand["area"] if poll["perArea"] else None,
+                        f"{cand['candidateNumber']} {cand['name']}",
+                    )
+                    for cand in candidates
+                ]
+
+            def activate(conn: Connection):
+                if poll["status"] == PollState.created and is_election:
+                    conn.execute("DELETE FROM options WHERE pollId = ?", [poll["id"]])
+                    conn.executemany(
                         "INSERT INTO options (pollId, candidateId, area, textFi, textEn, orderNo) VALUES (?, ?, ?, ?, ?, ?)",
                         [
                             [poll["id"], cand_id, cand_area, cand_text, cand_text, num]
                             for num, (cand_id, cand_area, cand_text) in enumerate(options)
                         ],
                     )
-                db.execute(
+                conn.execute(
                     f"UPDATE polls SET status='{PollState.active}', updatedAt=CURRENT_TIMESTAMP WHERE id=?", [pid]
                 )
+
+            await transaction(activate)
+            forget_rendering(pid)
+            forget_poll(pid)
             verb = "reactivated" if poll["status"] != PollState.created else "activated"
             await callback_query.answer(f"Poll {verb}.")
             await admin_log(
@@ -421,6 +442,7 @@ async def newpoll_callback(update: Update, context: AppContext):
             if poll["status"] != PollState.created:
                 context.application.create_task(reopen_poll(context, pid))
             poll = {**poll, "status": PollState.active}
+            start_live_results(context.application, poll)
             return await newpoll_main_menu(update, context, pid, poll, top=f"<b>Poll {verb}.</b>")
 
         case "np_announce" | "np_announce2" | "np_close" | "np_close2" if poll["status"] != PollState.active:
@@ -430,7 +452,9 @@ async def newpoll_callback(update: Update, context: AppContext):
             await callback_query.answer()
             await update_menu(
                 update,
-                newpoll_menu_text(poll, bottom="<b>Are you sure you want to ANNOUNCE this poll to all voters?</b>"),
+                await newpoll_menu_text(
+                    poll, bottom="<b>Are you sure you want to ANNOUNCE this poll to all voters?</b>"
+                ),
                 reply_markup=InlineKeyboardMarkup(
                     [
                         [InlineKeyboardButton("Yes, announce!", callback_data=f"np_announce2:{pid}")],
@@ -448,7 +472,7 @@ async def newpoll_callback(update: Update, context: AppContext):
             await callback_query.answer()
             await update_menu(
                 update,
-                newpoll_menu_text(poll, bottom="<b>Are you sure you want to close this poll?</b>"),
+                await newpoll_menu_text(poll, bottom="<b>Are you sure you want to close this poll?</b>"),
                 reply_markup=InlineKeyboardMarkup(
                     [
                         [InlineKeyboardButton("Yes, close!", callback_data=f"np_close2:{pid}")],
@@ -458,13 +482,16 @@ async def newpoll_callback(update: Update, context: AppContext):
             )
             return NP_MENU
         case "np_close2":
-            with db:
-                db.execute(
-                    f"UPDATE polls SET status='{PollState.closed}', updatedAt=CURRENT_TIMESTAMP WHERE id=?", [pid]
-                )
+            # stop taking votes from memory before the poll is closed in the database
+            forget_poll(pid)
+            await execute(
+                f"UPDATE polls SET status='{PollState.closed}', updatedAt=CURRENT_TIMESTAMP WHERE id=?", [pid]
+            )
+            forget_poll(pid)
             await callback_query.answer("Poll closed.")
             await admin_log(f"closed the poll <b>{escape(poll['textFi'])}</b>.", update, context)
             context.application.create_task(close_poll(context, pid))
+            stop_live_results(pid)
             poll = {**poll, "status": PollState.closed}
             return await newpoll_main_menu(update, context, pid, poll, top="<b>Poll closed.</b>")
 
@@ -475,30 +502,29 @@ async def newpoll_callback(update: Update, context: AppContext):
             await callback_query.answer()
             result = escape(poll["textFi"])
             if poll["perArea"]:
-                votes = db.execute(
+                votes = await fetch_all(
                     """
-                    SELECT options.textFi, votes.area, options.candidateId, COUNT(*) AS count
-                    FROM votes
-                    INNER JOIN options ON votes.optionId = options.id
-                    WHERE votes.pollId = ?
-                    GROUP BY votes.optionId, votes.area
-                    ORDER BY votes.area ASC, count DESC
+                    SELECT options.textFi, voteTallies.area, options.candidateId, voteTallies.count
+                    FROM voteTallies
+                    INNER JOIN options ON voteTallies.optionId = options.id
+                    WHERE voteTallies.pollId = ?
+                    ORDER BY voteTallies.area ASC, voteTallies.count DESC
                     """,
                     [poll["id"]],
-                ).fetchall()
+                )
                 by_area = grouplist(votes, lambda vote: vote["area"])
             else:
-                votes = db.execute(
+                votes = await fetch_all(
                     """
-                    SELECT options.textFi, options.candidateId, COUNT(*) AS count
-                    FROM votes
-                    INNER JOIN options ON votes.optionId = options.id
-                    WHERE votes.pollId = ?
-                    GROUP BY votes.optionId
+                    SELECT options.textFi, options.candidateId, SUM(voteTallies.count) AS count
+                    FROM voteTallies
+                    INNER JOIN options ON voteTallies.optionId = options.id
+                    WHERE voteTallies.pollId = ?
+                    GROUP BY voteTallies.optionId
                     ORDER BY count DESC
                     """,
                     [poll["id"]],
-                ).fetchall()
+                )
                 by_area = {None: votes}
             for area, votes in by_area.items():
                 if area is not None:
@@ -525,7 +551,7 @@ async def newpoll_edit_menu(update: Update, context: AppContext, pid: int, poll:
     bottom = "<b>Unsaved changes!</b>" if pending else "<b>What should be edited?</b>"
     await update_menu(
         update,
-        newpoll_menu_text(poll, bottom=bottom, pending=pending),
+        await newpoll_menu_text(poll, bottom=bottom, pending=pending),
         reply_markup=InlineKeyboardMarkup(
             [
                 *(([InlineKeyboardButton("Save changes", callback_data=f"np_commit:{pid}")],) if pending else ()),
@@ -568,7 +594,7 @@ async def newpoll_main_menu(
     force_edit=False,
 ):
     if poll is None:
-        poll = db.execute("SELECT * FROM polls WHERE id = ?", [pid]).fetchone()
+        poll = await fetch_one("SELECT * FROM polls WHERE id = ?", [pid])
         if poll is None:
             await update_menu(update, "Poll not found!", reply_markup=None)
             return END
@@ -576,7 +602,7 @@ async def newpoll_main_menu(
         return await newpoll_edit_menu(update, context, pid, poll)
     await update_menu(
         update,
-        newpoll_menu_text(poll, top=top, bottom=bottom),
+        await newpoll_menu_text(poll, top=top, bottom=bottom),
         reply_markup=InlineKeyboardMarkup(
             [
                 *(
@@ -612,10 +638,10 @@ async def poll_chooser(update: Update, context: AppContext):
         offset = int((update.callback_query.data or "").removeprefix("polls:"))
     else:
         offset = 0
-    (poll_count,) = db.execute("SELECT COUNT(*) FROM polls").fetchone()
-    polls: list[DbPoll] = db.execute(
+    (poll_count,) = await fetch_one("SELECT COUNT(*) FROM polls")
+    polls: list[DbPoll] = await fetch_all(
         "SELECT * FROM polls ORDER BY updatedAt DESC LIMIT ? OFFSET ?", [CHOOSER_PAGE_SIZE, offset]
-    ).fetchall()
+    )
     paging: list[InlineKeyboardButton] = []
     if offset > 0:
         paging.append(InlineKeyboardButton("<<", callback_data=f"polls:{max(0, offset - CHOOSER_PAGE_SIZE)}"))
@@ -649,25 +675,21 @@ async def poll_chooser(update: Update, context: AppContext):
 @require_setup
 async def handle_current(update: Update, context: AppContext, user: DbUser):
     message = cast(Message, update.effective_message)
-    current_polls: list[DbPoll] = db.execute(f"SELECT * FROM polls WHERE status = '{PollState.active}'").fetchall()
+    current_polls: list[DbPoll] = await fetch_all(f"SELECT * FROM polls WHERE status = '{PollState.active}'")
     if not current_polls:
         await message.reply_text(loc(context)["no_current_polls"])
         return END
     for poll in current_polls:
-        if not is_member(poll["voterGroup"], user):
+        if not await is_member(poll["voterGroup"], user):
             continue
-        messages = db.execute(
-            f"SELECT messageId FROM sentMessages WHERE chatId = ? AND pollId = ? AND isAdmin = FALSE",
+        messages = await fetch_all(
+            f"SELECT messageId FROM sentMessages WHERE chatId = ? AND pollId = ? AND isAdmin = FALSE AND status != '{MessageState.deleted}'",
             [message.chat_id, poll["id"]],
-        ).fetchall()
+        )
         for db_msg in messages:
             async with log_errors(context):
                 await context.bot.delete_message(chat_id=message.chat_id, message_id=db_msg["messageId"])
-            with db:
-                db.execute(
-                    "DELETE FROM sentMessages WHERE chatId = ? AND messageId = ?",
-                    [message.chat_id, db_msg["messageId"]],
-                )
+            await set_message_status(message.chat_id, db_msg["messageId"], MessageState.deleted)
         await send_poll(context, poll, user)
     return END
 
@@ -675,23 +697,10 @@ async def handle_current(update: Update, context: AppContext, user: DbUser):
 @require_setup
 async def poll_callback(update: Update, context: AppContext, user: DbUser):
     callback_query = cast(CallbackQuery, update.callback_query)
+    message = cast(Message, callback_query.message)
     action, oid = (callback_query.data or "").split(":")
     oid = int(oid)
-    row = db.execute(
-        """
-        SELECT
-            options.id AS optionId,
-            options.textFi AS optionFi,
-            options.textEn AS optionEn,
-            options.area as optionArea,
-            polls.id AS pollId,
-            polls.*
-        FROM options
-        INNER JOIN polls ON options.pollId = polls.id
-        WHERE options.id = ?
-        """,
-        [oid],
-    ).fetchone()
+    row = await get_vote_option(oid)
     if not row:
         await callback_query.answer("Internal error - invalid option", show_alert=True)
         return END
@@ -700,7 +709,7 @@ async def poll_callback(update: Update, context: AppContext, user: DbUser):
     lang = cast(str, user["language"])
     if action == "vote_cancel":
         await callback_query.answer()
-        _, messages, keyboards = format_poll(row, (lang,))
+        _, messages, keyboards = await format_poll(row)
         opts_key = (lang, user["area"]) if row["perArea"] else lang
         if opts_key not in keyboards:
             opts_key = (lang, None)  # non-elections don't have per-area options
@@ -711,7 +720,7 @@ async def poll_callback(update: Update, context: AppContext, user: DbUser):
         return END
 
     # validate that the user can vote on this option
-    if not is_member(row["voterGroup"], user):
+    if not await is_member(row["voterGroup"], user):
         await callback_query.answer(
             "Seems like you're a hacker - you can't vote in this poll. Have a beer (at your cost)", show_alert=True
         )
@@ -730,33 +739,27 @@ async def poll_callback(update: Update, context: AppContext, user: DbUser):
         )
         return END
     question = row[f"text{lang.capitalize()}"]
-    if row["status"] != PollState.active:
-        closed = loc(context)["poll_closed" if row["type"] != "election" else "election_closed"]
+
+    async def refuse(text: str, status: MessageState):
         await callback_query.answer(
-            closed,
+            text,
             show_alert=True,
         )
         with ignore_errors(filter="not modified"):
             await callback_query.edit_message_text(
-                f"{escape(question)}\n\n<b>{closed}</b>", reply_markup=None, parse_mode=ParseMode.HTML
+                f"{escape(question)}\n\n<b>{text}</b>", reply_markup=None, parse_mode=ParseMode.HTML
             )
+        await set_message_status(message.chat_id, message.message_id, status)
         return END
 
+    closed = loc(context)["poll_closed" if row["type"] != "election" else "election_closed"]
+    already_voted = loc(context)["poll_already_voted" if row["type"] != "election" else "election_already_voted"]
+    if row["status"] != PollState.active:
+        return await refuse(closed, MessageState.closed)
+
     # prevent multiple votes
-    existing_vote = db.execute(
-        "SELECT 1 FROM votes WHERE pollId = ? AND voterId = ?", [row["pollId"], user["id"]]
-    ).fetchone()
-    if existing_vote:
-        closed = loc(context)["poll_already_voted" if row["type"] != "election" else "election_already_voted"]
-        await callback_query.answer(
-            closed,
-            show_alert=True,
-        )
-        with ignore_errors(filter="not modified"):
-            await callback_query.edit_message_text(
-                f"{escape(question)}\n\n<b>{closed}</b>", reply_markup=None, parse_mode=ParseMode.HTML
-            )
-        return END
+    if await has_voted(row["pollId"], user["id"]):
+        return await refuse(already_voted, MessageState.voted)
 
     match action:
         case "vote_vote":
@@ -781,11 +784,13 @@ async def poll_callback(update: Update, context: AppContext, user: DbUser):
                 )
             return END
         case "vote_confirm":
-            with db:
-                db.execute(
-                    "INSERT OR IGNORE INTO votes (pollId, voterId, optionId, area) VALUES (?, ?, ?, ?)",
-                    [row["pollId"], user["id"], row["optionId"], user["area"]],
-                )
+            match await record_vote(
+                row["pollId"], user["id"], row["optionId"], user["area"], message.chat_id, message.message_id
+            ):
+                case VoteResult.already_voted:
+                    return await refuse(already_voted, MessageState.voted)
+                case VoteResult.poll_closed:
+                    return await refuse(closed, MessageState.closed)
             voted = loc(context)["poll_voted" if row["type"] != "election" else "election_voted"]
             await callback_query.answer(voted)
             with ignore_errors(filter="not modified"):
@@ -798,23 +803,45 @@ async def poll_callback(update: Update, context: AppContext, user: DbUser):
             return END
 
 
-def get_poll(poll_id: int | DbPoll) -> DbPoll:
+async def get_poll(poll_id: int | DbPoll) -> DbPoll:
     if isinstance(poll_id, int):
-        return db.execute("SELECT * FROM polls WHERE id = ?", [poll_id]).fetchone()
+        return await fetch_one("SELECT * FROM polls WHERE id = ?", [poll_id])
     else:
         return poll_id
 
 
-def format_poll(
-    poll: int | DbPoll,
-    langs: tuple[str, ...] = ("fi", "en"),
-) -> tuple[DbPoll, dict[str, str], dict[str | tuple[str, str | None], InlineKeyboardMarkup]]:
-    poll = get_poll(poll)
+PollKeyboards = dict[str | tuple[str, str | None], InlineKeyboardMarkup]
+
+# poll ID -> texts by language and keyboards by language (and area), dropped whenever the text or options change
+rendered_polls: dict[int, tuple[dict[str, str], PollKeyboards]] = {}
+# poll ID -> times its rendering has been dropped, so that a rendering started before that isn't stored
+render_versions: dict[int, int] = {}
+
+
+def forget_rendering(pid: int):
+    """Drops the cached rendering of a poll, call after changing its text or options."""
+    render_versions[pid] = render_versions.get(pid, 0) + 1
+    rendered_polls.pop(pid, None)
+
+
+async def format_poll(poll: int | DbPoll) -> tuple[DbPoll, dict[str, str], PollKeyboards]:
+    version = render_versions.get(poll if isinstance(poll, int) else poll["id"], 0)
+    poll = await get_poll(poll)
     if not poll:
         raise ValueError("poll missing")
-    options = db.execute(
+    rendered = rendered_polls.get(poll["id"])
+    if rendered is None:
+        rendered = await render_poll(poll)
+        if render_versions.get(poll["id"], 0) == version:
+            rendered_polls[poll["id"]] = rendered
+    return poll, *rendered
+
+
+async def render_poll(poll: DbPoll) -> tuple[dict[str, str], PollKeyboards]:
+    langs = ("fi", "en")
+    options = await fetch_all(
         "SELECT id, textFi, textEn, area FROM options WHERE pollId = ? ORDER BY orderNo ASC", [poll["id"]]
-    ).fetchall()
+    )
     messages = {lang: escape(poll[f"text{lang.capitalize()}"]) for lang in langs}
     if poll["perArea"]:
         areas = grouplist(options, lambda opt: opt["area"])
@@ -838,23 +865,19 @@ def format_poll(
             )
             for lang in langs
         }
-    return poll, messages, cast(dict, keyboards)
+    return messages, cast(dict, keyboards)
 
 
 async def send_poll(context: AppContext, poll: int | DbPoll, user: DbUser | None = None):
-    langs = (cast(str, user["language"]),) if user else ("fi", "en")
-    poll, messages, keyboards = format_poll(poll, langs)
-    targets = [user] if user is not None else get_group_member_users(poll["voterGroup"])
+    poll, messages, keyboards = await format_poll(poll)
+    targets = [user] if user is not None else await get_group_member_users(poll["voterGroup"])
     if user:
-        votes = db.execute(
-            "SELECT voterId FROM votes WHERE pollId = ? AND voterId = ?", [poll["id"], user["id"]]
-        ).fetchall()
+        votes = await fetch_all("SELECT voterId FROM votes WHERE pollId = ? AND voterId = ?", [poll["id"], user["id"]])
     else:
-        votes = db.execute("SELECT voterId FROM votes WHERE pollId = ?", [poll["id"]]).fetchall()
+        votes = await fetch_all("SELECT voterId FROM votes WHERE pollId = ?", [poll["id"]])
     votes = {vote["voterId"] for vote in votes}
     shuffle(targets)
-    attempted = 0
-    success = 0
+    items: list[OutboxItem] = []
     absent = 0
     voted = 0
     for target in targets:
@@ -876,27 +899,24 @@ async def send_poll(context: AppContext, poll: int | DbPoll, user: DbUser | None
                 continue
             key = "poll_already_voted" if poll["type"] != "election" else "election_already_voted"
             suffix = f"\n\n<b>{locale[lang][key]}</b>"
-        attempted += 1
-        try:
-            msg = await context.bot.send_message(
+        items.append(
+            outbox_send(
                 target["tgUserId"],
                 prefix + messages[lang] + suffix,
+                user_id=target["id"],
+                poll_id=poll["id"],
+                lang=lang,
+                status=MessageState.voted if target["id"] in votes else MessageState.open,
                 parse_mode=ParseMode.HTML,
                 reply_markup=None if target["id"] in votes else keyboards[opts_key],
             )
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            with db:
-                cur = db.cursor()
-                cur.execute(
-                    "INSERT INTO sentMessages (chatId, messageId, userId, pollId, language, isAdmin, status) VALUES (?, ?, ?, ?, ?, FALSE, 'open')",
-                    [msg.chat_id, msg.message_id, target["id"], poll["id"], lang],
-                )
-            success += 1
-    if not user:
+        )
+    if user:
+        await send_direct(context, items)
+    else:
+        success = await deliver_outbox(context, f"announcement of poll {poll['id']}", items)
         await admin_log(
-            f"Poll <b>{escape(poll['textFi'])}</b> sent successfully to {success} of {attempted} present users. "
+            f"Poll <b>{escape(poll['textFi'])}</b> sent successfully to {success} of {len(items)} present users. "
             f"{absent} absent users and {voted} already voted users skipped.",
             None,
             context,
@@ -904,53 +924,63 @@ async def send_poll(context: AppContext, poll: int | DbPoll, user: DbUser | None
 
 
 async def close_poll(context: AppContext, poll: int | DbPoll):
-    poll = get_poll(poll)
-    messages = db.execute(
-        f"SELECT chatId, messageId, language FROM sentMessages WHERE pollId = ? AND isAdmin = FALSE", [poll["id"]]
-    ).fetchall()
-    success = 0
-    attempted = 0
+    poll = await get_poll(poll)
+    # messages that already show the poll as closed are left alone
+    messages = await fetch_all(
+        f"""
+        SELECT chatId, messageId, language
+        FROM sentMessages
+        WHERE pollId = ? AND isAdmin = FALSE AND status NOT IN ('{MessageState.closed}', '{MessageState.deleted}')
+        """,
+        [poll["id"]],
+    )
+    items: list[OutboxItem] = []
     for db_msg in messages:
         lang = db_msg["language"]
         question = poll[f"text{lang.capitalize()}"]
         closed = locale[lang]["poll_closed" if poll["type"] != "election" else "election_closed"]
-        attempted += 1
-        try:
-            with ignore_errors(filter="not modified"):
-                await context.bot.edit_message_text(
-                    f"{escape(question)}\n\n<b>{closed}</b>",
-                    chat_id=db_msg["chatId"],
-                    message_id=db_msg["messageId"],
-                    reply_markup=None,
-                    parse_mode=ParseMode.HTML,
-                )
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            success += 1
+        items.append(
+            outbox_edit(
+                db_msg["chatId"],
+                db_msg["messageId"],
+                f"{escape(question)}\n\n<b>{closed}</b>",
+                status=MessageState.closed,
+                reply_markup=None,
+                parse_mode=ParseMode.HTML,
+            )
+        )
+    success = await deliver_outbox(context, f"closing of poll {poll['id']}", items)
     await admin_log(
-        f"Poll <b>{escape(poll['textFi'])}</b> closed successfully in {success} of {attempted} messages.",
+        f"Poll <b>{escape(poll['textFi'])}</b> closed successfully in {success} of {len(items)} messages.",
         None,
         context,
     )
 
 
 async def reopen_poll(context: AppContext, poll: int | DbPoll):
-    poll, messages, keyboards = format_poll(poll)
-    db_messages = db.execute(
+    poll, messages, keyboards = await format_poll(poll)
+    db_messages = await fetch_all(
         f"""
-        SELECT sentMessages.chatId, sentMessages.messageId, sentMessages.userId, users.language, users.area
+        SELECT
+            sentMessages.chatId,
+            sentMessages.messageId,
+            sentMessages.userId,
+            sentMessages.status,
+            users.language,
+            users.area
         FROM sentMessages
         INNER JOIN users ON sentMessages.userId = users.id
-        WHERE pollId = ? AND isAdmin = FALSE
+        WHERE pollId = ? AND isAdmin = FALSE AND sentMessages.status != '{MessageState.deleted}'
         """,
         [poll["id"]],
-    ).fetchall()
-    votes = db.execute("SELECT voterId FROM votes WHERE pollId = ?", [poll["id"]]).fetchall()
+    )
+    votes = await fetch_all("SELECT voterId FROM votes WHERE pollId = ?", [poll["id"]])
     votes = {vote["voterId"] for vote in votes}
-    success = 0
-    attempted = 0
+    items: list[OutboxItem] = []
     for db_msg in db_messages:
+        status = MessageState.voted if db_msg["userId"] in votes else MessageState.open
+        if db_msg["status"] == status:
+            continue
         lang = db_msg["language"]
         opts_key = (lang, db_msg["area"]) if poll["perArea"] else lang
         if opts_key not in keyboards:
@@ -959,22 +989,19 @@ async def reopen_poll(context: AppContext, poll: int | DbPoll):
         if db_msg["userId"] in votes:
             key = "poll_already_voted" if poll["type"] != "election" else "election_already_voted"
             suffix = f"\n\n<b>{locale[lang][key]}</b>"
-        attempted += 1
-        try:
-            with ignore_errors(filter="not modified"):
-                await context.bot.edit_message_text(
-                    messages[lang] + suffix,
-                    chat_id=db_msg["chatId"],
-                    message_id=db_msg["messageId"],
-                    reply_markup=None if db_msg["userId"] in votes else keyboards[opts_key],
-                    parse_mode=ParseMode.HTML,
-                )
-        except TelegramError as err:
-            await context.application.process_error(None, err)
-        else:
-            success += 1
+        items.append(
+            outbox_edit(
+                db_msg["chatId"],
+                db_msg["messageId"],
+                messages[lang] + suffix,
+                status=status,
+                reply_markup=None if db_msg["userId"] in votes else keyboards[opts_key],
+                parse_mode=ParseMode.HTML,
+            )
+        )
+    success = await deliver_outbox(context, f"reopening of poll {poll['id']}", items)
     await admin_log(
-        f"Poll <b>{escape(poll['textFi'])}</b> reopened successfully in {success} of {attempted} messages.",
+        f"Poll <b>{escape(poll['textFi'])}</b> reopened successfully in {success} of {len(items)} messages.",
         None,
         context,
     )
@@ -0,0 +1,92 @@
+import re
+from dataclasses import dataclass
+from logging import getLogger
+from sqlite3 import Connection, Cursor
+from threading import Lock
+from time import perf_counter
+from typing import Any, Iterable
+
+from config import config
+from metrics import DB_SECONDS
+
+LOGGER = getLogger("dsitsibot.db")
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+
+def normalize(sql: str):
+    sql = re.sub(r"\s+", " ", sql).strip()
+    # IN lists are built per call, they'd otherwise each get their own entry
+    return re.sub(r"IN \(\?(?:, \?)*\)", "IN (...)", sql)
+
+
+class Profiler:
+    def __init__(self, slow_query: float):
+        self.slow_query = slow_query
+        self.lock = Lock()
+        self.stats: dict[str, QueryStats] = {}
+        self.explained: set[str] = set()
+
+    def record(self, sql: str, elapsed: float):
+        """Returns whether the statement is slow and hasn't been explained yet."""
+        with self.lock:
+            stats = self.stats.get(sql)
+            if stats is None:
+                stats = self.stats[sql] = QueryStats()
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            if elapsed < self.slow_query or sql in self.explained:
+                return False
+            self.explained.add(sql)
+            return True
+
+    def summary(self, limit: int):
+        with self.lock:
+            return sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.explained.clear()
+
+
+profiler = Profiler(config["profiling"]["slow_query_ms"] / 1000)
+
+
+class ProfiledConnection(Connection):
+    """Records timings of every statement in the profiler. For queries, this is the time to the first row, which is
+    when sqlite does the work for sorts and aggregates."""
+
+    def execute(self, sql: str, parameters: Any = (), /) -> Cursor:
+        start = perf_counter()
+        cur = super().execute(sql, parameters)
+        self.finished(sql, parameters, perf_counter() - start)
+        return cur
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any], /) -> Cursor:
+        start = perf_counter()
+        cur = super().executemany(sql, seq_of_parameters)
+        self.finished(sql, None, perf_counter() - start)
+        return cur
+
+    def finished(self, sql: str, parameters: Any, elapsed: float):
+        key = normalize(sql)
+        DB_SECONDS.observe(elapsed, key.split(" ", 1)[0].upper())
+        if not profiler.record(key, elapsed):
+            if elapsed >= profiler.slow_query:
+                LOGGER.warning("Slow query (%.1f ms): %s", elapsed * 1000, key)
+            return
+        plan = ""
+        if parameters is not None and not key.startswith("EXPLAIN"):
+            try:
+                rows = super().execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+                plan = "\n".join(f"  {row[3]}" for row in rows)
+            except Exception as err:
+                plan = f"  (no plan: {err})"
+        LOGGER.warning("Slow query (%.1f ms): %s\n%s", elapsed * 1000, key, plan)
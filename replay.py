@@ -0,0 +1,129 @@
+"""Replays recorded updates against the bot with a fake Bot API, and reports handler latency and throughput.
+
+Record updates with the update log (update_log.enabled = true, no fields), then run:
+
+    python replay.py updates.jsonl [--repeat N]
+
+The handlers run against the database in config.toml, so point it at a copy of the production database.
+"""
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Any
+
+from telegram import Update
+from telegram.ext import Application
+
+from fakeapi import FakeBotApi, FakeRequest
+from main import build_app
+from update_log import update_log
+
+
+def label(update: Update) -> str:
+    """Groups updates by what they do: the command, the callback data prefix or the update type."""
+    if update.callback_query is not None:
+        return (update.callback_query.data or "").partition(":")[0] or Update.CALLBACK_QUERY
+    message = update.message or update.edited_message
+    if message is not None and message.text and message.text.startswith("/"):
+        return message.text.split()[0].partition("@")[0]
+    for kind in Update.ALL_TYPES:
+        if getattr(update, kind, None) is not None:
+            return kind
+    return "unknown"
+
+
+def percentile(values: list[float], q: float) -> float:
+    """values must be sorted"""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_updates(path: str) -> list[dict[str, Any]]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+@asynccontextmanager
+async def running(app: Application):
+    """Runs the application's lifecycle like run_polling does, without fetching updates."""
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        yield app
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+class Benchmark:
+    """Feeds updates to an application the way it processes them itself, including the per user and chat ordering,
+    and times each handler."""
+
+    def __init__(self, app: Application):
+        self.app = app
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors = 0
+        app.add_error_handler(self.count_error)
+
+    async def count_error(self, _update, _context):
+        self.errors += 1
+
+    async def timed(self, update: Update):
+        start = perf_counter()
+        await self.app.process_update(update)
+        self.latencies[label(update)].append(perf_counter() - start)
+
+    async def run(self, updates: list[Update]) -> float:
+        """Processes the updates concurrently and returns the seconds it took."""
+        start = perf_counter()
+        await asyncio.gather(
+            *(
+                asyncio.create_task(self.app.update_processor.process_update(update, self.timed(update)))
+                for update in updates
+            )
+        )
+        return perf_counter() - start
+
+    def report(self):
+        print(f"{'handler':<24}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, values in sorted(self.latencies.items(), key=lambda item: -len(item[1])):
+            values.sort()
+            print(
+                f"{name:<24}{len(values):>8}"
+                + "".join(f"{percentile(values, q) * 1000:>10.2f}" for q in (0.5, 0.9, 0.99))
+                + f"{values[-1] * 1000:>10.2f}"
+            )
+
+
+async def replay(updates: list[dict[str, Any]], repeat: int):
+    api = FakeBotApi(record=False)
+    app = build_app(FakeRequest(api), FakeRequest(api))
+    # don't record the replay into the log being replayed
+    update_log.enabled = False
+    benchmark = Benchmark(app)
+    async with running(app):
+        parsed = [Update.de_json(data, app.bot) for _ in range(repeat) for data in updates]
+        batch = [update for update in parsed if update is not None]
+        elapsed = await benchmark.run(batch)
+    benchmark.report()
+    print(f"{len(batch)} updates in {elapsed:.2f} s, {len(batch) / elapsed:.0f} updates/s, {benchmark.errors} errors")
+    print("API calls: " + ", ".join(f"{method} {n}" for method, n in api.counts.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the bot with a fake Bot API.")
+    parser.add_argument("path", help="updates recorded by the update log, as JSON lines")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the updates this many times")
+    args = parser.parse_args()
+    asyncio.run(replay(load_updates(args.path), args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import json
+from typing import Any
+
+from config import config
+from db import execute_many, load_all_kv
+
+
+class Settings:
+    """Write-through cache of the kv table. Read the attributes directly, then call save() with the names of the
+    ones that were changed. The sets are mutated in place so that references to them stay live."""
+
+    def __init__(self, values: dict[str, Any]):
+        self.admin_log: int | None = values.get("admin_log")
+        self.initiative_log: int = values.get("initiative_log", config["admins"][0])
+        self.initiative_alerts: list[int] = values.get(
+            "initiative_alerts", config["initiatives"]["default_alerts"]
+        )
+        self.admin_groups: set[int] = set(values.get("admin_groups", []))
+        self.banned_admins: set[int] = set(values.get("banned_admins", []))
+        # poll ID (a string, as JSON keys are) -> [chat ID, message ID] of its live results message
+        self.live_results: dict[str, list[int]] = values.get("live_results", {})
+
+    async def save(self, *keys: str):
+        rows = []
+        for key in keys:
+            value = getattr(self, key)
+            rows.append([key, json.dumps(sorted(value) if isinstance(value, set) else value)])
+        await execute_many("REPLACE INTO kv (key, value) VALUES (?, ?)", rows)
+
+
+settings = Settings(load_all_kv())
@@ -1,3 +1,4 @@
+import asyncio
 from random import shuffle
 from typing import cast, Any
 
@@ -6,8 +7,9 @@ from telegram.constants import ParseMode
 from telegram.error import TelegramError
 
 from config import config
-from db import db, DbUser, get_kv, DbPoll, DbInitiative
+from db import DbUser, DbPoll, DbInitiative, fetch_all, user_cache
 from langs import locale
+from settings import settings
 from typings import AppContext
 from util import escape, user_link, grouplist
 
@@ -50,7 +52,7 @@ async def admin_log(
     parse_mode: ParseMode | None = ParseMode.HTML,
     extra_target: int | None = None,
 ):
-    target = get_kv("admin_log", None)
+    target = settings.admin_log
     user = cast(User, update.effective_user) if update else None
     message = f"{user_link(user)} {action}" if user else action
     if user and user.id != config["admins"][0]:
@@ -64,46 +66,109 @@ async def admin_log(
             await context.bot.send_message(extra_target, message, parse_mode=parse_mode)
 
 
-def is_member(group: str, user: DbUser | int) -> bool:
-    if group == "everyone":
-        return True
-    if group in ("present", "absent"):
-        present = group == "present"
-        if isinstance(user, int):
-            row = db.execute("SELECT 1 FROM users WHERE id = ? AND present = ?", [user, present]).fetchone()
-            return row is not None
-        return user["present"]
-    uid = user if isinstance(user, int) else user["id"]
-    row = db.execute("SELECT 1 FROM groupMembers WHERE `group` = ? AND userId = ?", [group, uid]).fetchone()
-    return row is not None
+class Membership:
+    """In-memory copy of groupMembers and users.present, loaded on first use. Anything that writes to either must
+    call add(), remove() or set_present() afterwards, and anything that creates users must call add_users()."""
+
+    def __init__(self):
+        self.everyone: set[int] = set()
+        self.present: set[int] = set()
+        self.groups: dict[str, set[int]] = {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        # bumped on every change, so that a load that raced with one reads again
+        self.generation = 0
+
+    async def load(self):
+        if self.loaded:
+            return
+        async with self.lock:
+            while not self.loaded:
+                generation = self.generation
+                users = await fetch_all("SELECT id, present FROM users")
+                members = await fetch_all("SELECT `group`, userId FROM groupMembers")
+                if generation != self.generation:
+                    continue
+                self.everyone = {row["id"] for row in users}
+                self.present = {row["id"] for row in users if row["present"]}
+                self.groups = {}
+                for row in members:
+                    self.groups.setdefault(row["group"], set()).add(row["userId"])
+                self.loaded = True
+
+    def members(self, group: str) -> set[int]:
+        if group == "everyone":
+            return self.everyone
+        if group == "present":
+            return self.present
+        if group == "absent":
+            return self.everyone - self.present
+        return self.groups.get(group, set())
+
+    def add_users(self, uids: list[int]):
+        self.generation += 1
+        if self.loaded:
+            self.everyone.update(uids)
+
+    def add(self, group: str, uids: list[int]):
+        self.generation += 1
+        if self.loaded:
+            self.groups.setdefault(group, set()).update(uids)
+
+    def remove(self, group: str, uids: list[int]):
+        self.generation += 1
+        if self.loaded and group in self.groups:
+            self.groups[group].difference_update(uids)
+            if not self.groups[group]:
+                del self.groups[group]
+
+    def set_present(self, uids: list[int], present: bool):
+        self.generation += 1
+        if not self.loaded:
+            return
+        if present:
+            # users can be added to the database while the bot runs, they show up here when they log in
+            self.everyone.update(uids)
+            self.present.update(uids)
+        else:
+            self.present.difference_update(uids)
 
 
-def get_group_member_ids(group: str) -> list[int]:
-    if group == "everyone":
-        return [row["id"] for row in db.execute("SELECT id FROM users").fetchall()]
-    if group in ("present", "absent"):
-        return [
-            row["id"] for row in db.execute("SELECT id FROM users WHERE present = ?", [group == "present"]).fetchall()
-        ]
-    return [
-        row["userId"] for row in db.execute("SELECT userId FROM groupMembers WHERE `group` = ?", [group]).fetchall()
-    ]
+membership = Membership()
 
 
-def get_group_member_users(group: str) -> list[DbUser]:
+def presence_changed(uids: list[int], present: bool):
+    for uid in uids:
+        user_cache.update(uid, present=present)
+    membership.set_present(uids, present)
+
+
+async def is_member(group: str, user: DbUser | int) -> bool:
     if group == "everyone":
-        return db.execute("SELECT * FROM users").fetchall()
-    if group in ("present", "absent"):
-        return db.execute("SELECT * FROM users WHERE present = ?", [group == "present"]).fetchall()
-    return db.execute(
-        """
-        SELECT users.*
-        FROM groupMembers
-        INNER JOIN users ON users.id = groupMembers.userId
-        WHERE groupMembers.`group` = ?
-        """,
-        [group],
-    ).fetchall()
+        return True
+    await membership.load()
+    uid = user if isinstance(user, int) else user["id"]
+    if group == "absent":
+        return uid not in membership.present
+    return uid in membership.members(group)
+
+
+async def get_group_member_ids(group: str) -> list[int]:
+    await membership.load()
+    return sorted(membership.members(group))
+
+
+async def get_group_member_users(group: str) -> list[DbUser]:
+    uids = await get_group_member_ids(group)
+    users = {uid: user for uid in uids if (user := user_cache.get(uid)) is not None}
+    missing = [uid for uid in uids if uid not in users]
+    generation = user_cache.generation
+    # stay well under SQLite's variable limit
+    for start in range(0, len(missing), 500):
+        chunk = missing[start : start + 500]
+        for row in await fetch_all(f"SELECT * FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk):
+            users[row["id"]] = user_cache.put(row, generation)
+    return [users[uid] for uid in uids if uid in users]
 
 
 async def update_menu(
@@ -11,6 +11,15 @@ class PollState(StrEnum):
     closed = auto()
 
 
+class MessageState(StrEnum):
+    """What a poll or initiative message in sentMessages currently shows"""
+
+    open = auto()
+    voted = auto()
+    closed = auto()
+    deleted = auto()
+
+
 class InitiativeState(StrEnum):
     submitted = auto()
     shitpost = auto()
@@ -0,0 +1,106 @@
+import json
+from logging import INFO, Formatter, getLogger
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from random import random
+from typing import Any
+
+from telegram import Update
+from telegram.ext import BaseHandler
+
+from config import config
+
+LOGGER = getLogger("dsitsibot.updates")
+LOGGER.setLevel(INFO)
+LOGGER.propagate = False
+
+
+def pick(data: dict[str, Any], fields: list[str]) -> dict[str, Any]:
+    """Keeps only the given dotted paths of data, e.g. ["update_id", "message.text"]."""
+    result: dict[str, Any] = {}
+    for path in fields:
+        *parents, leaf = path.split(".")
+        source, target = data, result
+        for part in parents:
+            source = source.get(part)
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(part, {})
+        else:
+            if leaf in source:
+                target[leaf] = source[leaf]
+    return result
+
+
+class DeferredQueueHandler(QueueHandler):
+    # the default prepare() formats the record right away, in the event loop thread
+    def prepare(self, record):
+        return record
+
+
+class UpdateLog:
+    """Writes incoming updates as JSON lines to a rotating file. Formatting and file I/O happen in a background
+    thread, so a slow disk doesn't hold up the event loop."""
+
+    def __init__(self):
+        settings = config["update_log"]
+        self.enabled = settings["enabled"]
+        self.sample_rate = settings["sample_rate"]
+        self.fields: list[str] = settings["fields"]
+        self.listener: QueueListener | None = None
+
+    def start(self):
+        settings = config["update_log"]
+        queue: SimpleQueue = SimpleQueue()
+        file_handler = RotatingFileHandler(
+            settings["path"],
+            maxBytes=settings["max_bytes"],
+            backupCount=settings["backups"],
+            encoding="utf-8",
+            delay=True,
+        )
+        file_handler.setFormatter(Formatter("%(message)s"))
+        LOGGER.addHandler(DeferredQueueHandler(queue))
+        self.listener = QueueListener(queue, file_handler)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        LOGGER.handlers.clear()
+
+    def record(self, update: Update):
+        if not self.enabled or (self.sample_rate < 1 and random() >= self.sample_rate):
+            return
+        data = update.to_dict()
+        if self.fields:
+            data = pick(data, self.fields)
+        LOGGER.info("%s", Lazy(data))
+
+
+class Lazy:
+    """Defers json.dumps until the record is formatted in the listener thread."""
+
+    def __init__(self, data: dict[str, Any]):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+update_log = UpdateLog()
+
+
+class UpdateLogHandler(BaseHandler):
+    # only looks at whatever the other handlers subscribe to
+    update_types: set[str] = set()
+
+    def __init__(self):
+        super().__init__(self.handle, True)
+
+    async def handle(self, update: Update, _ctx):
+        update_log.record(update)
+
+    def check_update(self, update):
+        return isinstance(update, Update)
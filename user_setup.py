@@ -1,5 +1,6 @@
 from datetime import datetime
 from functools import wraps
+from sqlite3 import Connection
 from typing import cast, Coroutine, Callable
 
 from telegram import (
@@ -16,11 +17,11 @@ from telegram import (
 from telegram.constants import ParseMode
 from telegram.ext import ConversationHandler
 
-from db import db, get_user, DbUser
+from db import DbUser, execute, get_user, transaction, user_cache
 from filters import ADMIN
 from help import send_help, user_commands
 from langs import lang_icons, locale, loc
-from shared import log_errors
+from shared import log_errors, membership, presence_changed
 from typings import AppContext
 
 
@@ -51,7 +52,7 @@ async def handle_language(update: Update, context: AppContext):
 
 async def handle_start(update: Update, context: AppContext):
     message = cast(Message, update.effective_message)
-    user = get_user(update)
+    user = await get_user(update)
     if user:
         context.user_data.lang = user["language"]
         await send_help(message.chat, user, context)
@@ -84,15 +85,15 @@ async def lang_callback(update: Update, context: AppContext):
                         [BotCommand(cmd, desc) for cmd, _, desc in user_commands[new_lang]],
                         scope=BotCommandScopeChat(chat_id=callback_query.from_user.id),
                     )
-            user = get_user(update)
+            user = await get_user(update)
             if user is None:
                 return await ask_code(callback_query.from_user, context)
             else:
-                with db:
-                    db.execute(
-                        "UPDATE users SET language=? WHERE id = ?",
-                        [new_lang, user["id"]],
-                    )
+                await execute(
+                    "UPDATE users SET language=? WHERE id = ?",
+                    [new_lang, user["id"]],
+                )
+                user_cache.update(user["id"], language=new_lang)
                 await send_help(callback_query.from_user, user, context)
                 return END
         case _:
@@ -111,40 +112,43 @@ async def ask_code(user: User, context: AppContext):
 async def save_code(update: Update, context: AppContext):
     message = cast(Message, update.effective_message)
     code = cast(str, message.text).strip().upper()
-    with db:
-        cur = db.cursor()
-        # I'd like to do this, but it's not thread or task safe
-        # cur.execute("BEGIN EXCLUSIVE")
-        user = cur.execute("SELECT * FROM users WHERE passcode = ?", [code]).fetchone()
+    tg_user = cast(User, message.from_user)
+    lang = context.user_data.lang
+
+    # runs in the writer thread, so the check and the claim can't interleave with another registration
+    def claim(conn: Connection) -> tuple[str | None, DbUser | None]:
+        user = conn.execute("SELECT * FROM users WHERE passcode = ?", [code]).fetchone()
         if user is None:
-            await message.chat.send_message(
-                loc(context)["invalid_code"],
-                parse_mode=ParseMode.HTML,
-                reply_markup=ForceReply(input_field_placeholder=loc(context)["code_placeholder"]),
-            )
-            return REG_CODE
-        tg_user = cast(User, message.from_user)
+            return "invalid_code", None
         if user["tgUserId"] is not None or (
             user["tgUsername"] is not None and user["tgUsername"].lower() != (tg_user.username or "").lower()
         ):
-            await message.chat.send_message(
-                loc(context)["used_code"],
-                parse_mode=ParseMode.HTML,
-                reply_markup=ForceReply(input_field_placeholder=loc(context)["code_placeholder"]),
-            )
-            return REG_CODE
-        cur.execute(
+            return "used_code", None
+        conn.execute(
             "UPDATE users SET tgUserId=?, tgUsername=?, tgDisplayName=?, language=?, present=1 WHERE id = ?",
-            [tg_user.id, tg_user.username, tg_user.full_name.strip(), context.user_data.lang, user["id"]],
+            [tg_user.id, tg_user.username, tg_user.full_name.strip(), lang, user["id"]],
         )
-        await send_help(message.chat, user, context)
+        return None, user
+
+    error, user = await transaction(claim)
+    user_cache.invalidate(user["id"] if user else None, tg_user.id)
+    if user is not None:
+        membership.set_present([user["id"]], True)
+    if error is not None:
+        await message.chat.send_message(
+            loc(context)[error],
+            parse_mode=ParseMode.HTML,
+            reply_markup=ForceReply(input_field_placeholder=loc(context)["code_placeholder"]),
+        )
+        return REG_CODE
+    await send_help(message.chat, user, context)
     return END
 
 
 def require_setup(func: Callable[[Update, AppContext, DbUser], Coroutine]):
     @wraps(func)
     async def handle(update: Update, context: AppContext):
-        user = get_user(update)
+        user = await get_user(update)
         if not context.user_data.lang:
             if user:
                 context.user_data.lang = user["language"]
@@ -166,20 +170,20 @@ def require_setup(func: Callable[[Update, AppContext, DbUser], Coroutine]):
 
 @require_setup
 async def handle_absent(update: Update, context: AppContext, user: DbUser):
-    with db:
-        db.execute(
-            "UPDATE users SET present=0 WHERE id = ?",
-            [user["id"]],
-        )
+    await execute(
+        "UPDATE users SET present=0 WHERE id = ?",
+        [user["id"]],
+    )
+    presence_changed([user["id"]], False)
     await cast(User, update.effective_user).send_message(loc(context)["absent"])
     return END
 
 
 async def mark_not_absent(update: Update, context: AppContext, user: DbUser):
     if not user["present"]:
-        with db:
-            db.execute(
-                "UPDATE users SET present=1 WHERE id = ?",
-                [user["id"]],
-            )
+        await execute(
+            "UPDATE users SET present=1 WHERE id = ?",
+            [user["id"]],
+        )
+        presence_changed([user["id"]], True)
         await cast(User, update.effective_user).send_message(loc(context)["unabsent"])
@@ -0,0 +1,169 @@
+from dataclasses import dataclass, field
+from enum import StrEnum, auto
+from sqlite3 import Connection
+from typing import Any
+
+from config import config
+from db import BatchWriter, DbPoll, fetch_all, fetch_one
+from live_results import note_vote
+from metrics import VOTES
+from outbox import done_writer
+from typings import MessageState, PollState
+
+
+@dataclass
+class PollVotes:
+    """What poll_callback needs to know about an active poll, kept in memory while the poll is active"""
+
+    poll: DbPoll
+    options: dict[int, Any]
+    voters: set[int] = field(default_factory=set)
+
+
+class VoteResult(StrEnum):
+    recorded = auto()
+    already_voted = auto()
+    poll_closed = auto()
+
+
+active_polls: dict[int, PollVotes] = {}
+# option ID -> poll ID for the options of active_polls
+option_polls: dict[int, int] = {}
+# poll ID -> times forget_poll has been called for it, so that a load that read the poll before that isn't installed
+poll_generations: dict[int, int] = {}
+
+
+async def load_poll_votes(poll: DbPoll, generation: int) -> PollVotes | None:
+    """Loads the state of an active poll read when poll_generations was at generation. Returns None if the poll has
+    been forgotten since."""
+    options = await fetch_all("SELECT id, textFi, textEn, area FROM options WHERE pollId = ?", [poll["id"]])
+    voters = await fetch_all("SELECT voterId FROM votes WHERE pollId = ?", [poll["id"]])
+    if poll_generations.get(poll["id"], 0) != generation:
+        return None
+    # another callback may have loaded the poll meanwhile
+    if poll["id"] in active_polls:
+        return active_polls[poll["id"]]
+    state = PollVotes(dict(poll), {opt["id"]: opt for opt in options}, {row["voterId"] for row in voters})
+    active_polls[poll["id"]] = state
+    for oid in state.options:
+        option_polls[oid] = poll["id"]
+    return state
+
+
+def forget_poll(pid: int):
+    """Drops the in-memory state of a poll, call whenever its status changes: before changing it, so that no votes
+    are taken from memory meanwhile, and again after, to drop a state loaded from before the change."""
+    poll_generations[pid] = poll_generations.get(pid, 0) + 1
+    state = active_polls.pop(pid, None)
+    if state is not None:
+        for oid in state.options:
+            option_polls.pop(oid, None)
+
+
+def option_row(state: PollVotes, oid: int):
+    option = state.options[oid]
+    return {
+        **state.poll,
+        "optionId": option["id"],
+        "optionFi": option["textFi"],
+        "optionEn": option["textEn"],
+        "optionArea": option["area"],
+        "pollId": state.poll["id"],
+    }
+
+
+async def get_vote_option(oid: int) -> Any:
+    """Returns the option joined with its poll, like the polls.*, options.* rows elsewhere. Active polls are served
+    from memory."""
+    pid = option_polls.get(oid)
+    if pid is not None:
+        return option_row(active_polls[pid], oid)
+    generations = dict(poll_generations)
+    row = await fetch_one(
+        """
+        SELECT
+            options.id AS optionId,
+            options.textFi AS optionFi,
+            options.textEn AS optionEn,
+            options.area as optionArea,
+            polls.id AS pollId,
+            polls.*
+        FROM options
+        INNER JOIN polls ON options.pollId = polls.id
+        WHERE options.id = ?
+        """,
+        [oid],
+    )
+    if row is not None and row["status"] == PollState.active:
+        poll = await fetch_one("SELECT * FROM polls WHERE id = ?", [row["pollId"]])
+        state = await load_poll_votes(poll, generations.get(row["pollId"], 0))
+        if state is not None and oid in state.options:
+            return option_row(state, oid)
+    return row
+
+
+async def has_voted(pid: int, uid: int) -> bool:
+    state = active_polls.get(pid)
+    if state is not None:
+        return uid in state.voters
+    return await fetch_one("SELECT 1 FROM votes WHERE pollId = ? AND voterId = ?", [pid, uid]) is not None
+
+
+def write_votes(conn: Connection, votes: list[tuple[Any, ...]]) -> list[VoteResult]:
+    results = []
+    for pid, uid, oid, area, chat_id, message_id in votes:
+        # votes are checked against memory, the poll may have been closed since
+        cur = conn.execute(
+            f"""
+            INSERT OR IGNORE INTO votes (pollId, voterId, optionId, area)
+            SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM polls WHERE id = ? AND status = '{PollState.active}')
+            """,
+            [pid, uid, oid, area, pid],
+        )
+        if not cur.rowcount:
+            active = conn.execute(
+                f"SELECT 1 FROM polls WHERE id = ? AND status = '{PollState.active}'", [pid]
+            ).fetchone()
+            results.append(VoteResult.already_voted if active else VoteResult.poll_closed)
+            continue
+        conn.execute(
+            """
+            INSERT INTO voteTallies (pollId, optionId, area, count) VALUES (?, ?, ?, 1)
+            ON CONFLICT (pollId, optionId, area) DO UPDATE SET count = count + 1
+            """,
+            [pid, oid, area],
+        )
+        conn.execute(
+            "UPDATE sentMessages SET status=? WHERE chatId = ? AND messageId = ?",
+            [MessageState.voted, chat_id, message_id],
+        )
+        results.append(VoteResult.recorded)
+    return results
+
+
+# votes arriving together share one transaction and fsync
+vote_writer = BatchWriter(write_votes, config["votes"]["batch_rows"], config["votes"]["batch_delay"])
+
+
+async def record_vote(pid: int, uid: int, oid: int, area: str, chat_id: int, message_id: int) -> VoteResult:
+    """Records a vote once it's stored."""
+    state = active_polls.get(pid)
+    if state is not None:
+        if uid in state.voters:
+            return VoteResult.already_voted
+        state.voters.add(uid)
+    # a message delivered moments ago may still have its sentMessages row in the batch, and write_votes updates it
+    await done_writer.flush()
+    result = await vote_writer.add((pid, uid, oid, area, chat_id, message_id))
+    if not result:
+        if state is not None:
+            state.voters.discard(uid)
+        raise RuntimeError(f"Failed to store vote of user {uid} in poll {pid}")
+    if result == VoteResult.poll_closed:
+        if state is not None:
+            state.voters.discard(uid)
+        return result
+    if result == VoteResult.recorded:
+        note_vote(pid)
+        VOTES.inc()
+    return result
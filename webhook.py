@@ -0,0 +1,104 @@
+"""Receives updates over HTTP instead of polling, enabled with webhook.enabled.
+
+This doesn't use Application.run_webhook because:
+- it needs tornado (python-telegram-bot[webhooks]), which isn't a dependency here;
+- it always calls setWebhook on startup, making up a URL from listen and port if none is given, while webhook.url
+  is left empty when the webhook is registered elsewhere, e.g. for several instances behind one endpoint.
+The small server in httpserver.py is already here for /metrics and fakeapi.py.
+"""
+import asyncio
+import hmac
+import json
+import signal
+import sys
+from urllib.error import HTTPError
+from urllib.request import Request as UrlRequest, urlopen
+
+from telegram import Update
+from telegram.ext import Application
+
+from config import config
+from httpserver import Handler, HttpServer, Request, Response
+
+
+def webhook_handler(app: Application) -> Handler:
+    secret = config["webhook"]["secret_token"].encode()
+
+    async def handle(request: Request) -> Response:
+        if request.method != "POST":
+            return Response(405, b"method not allowed")
+        if not hmac.compare_digest(request.headers.get("x-telegram-bot-api-secret-token", "").encode(), secret):
+            return Response(403, b"forbidden")
+        try:
+            update = Update.de_json(json.loads(request.body), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return Response(400, b"invalid update")
+        if update is None:
+            return Response(400, b"invalid update")
+        await app.update_queue.put(update)
+        return Response(200)
+
+    return handle
+
+
+async def serve(app: Application, allowed_updates: list[str]):
+    webhook = config["webhook"]
+    if not webhook["secret_token"]:
+        raise ValueError("webhook.secret_token must be set to use the webhook")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # same lifecycle as Application.run_polling, minus the Updater
+    await app.initialize()
+    server = HttpServer({webhook["path"]: webhook_handler(app)})
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        # with several workers behind one proxy, only one of them should register the webhook
+        if webhook["url"]:
+            await app.bot.set_webhook(
+                webhook["url"], secret_token=webhook["secret_token"], allowed_updates=allowed_updates
+            )
+        await server.start(webhook["listen"], webhook["port"])
+        await app.start()
+        await stop.wait()
+    finally:
+        await server.close()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def run_webhook(app: Application, allowed_updates: list[str]):
+    asyncio.run(serve(app, allowed_updates))
+
+
+def post_updates(path: str):
+    """Posts the updates in a JSON lines file to the local webhook, for testing."""
+    webhook = config["webhook"]
+    url = f"http://{webhook['listen']}:{webhook['port']}{webhook['path']}"
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            request = UrlRequest(
+                url,
+                data=line.encode(),
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Telegram-Bot-Api-Secret-Token": webhook["secret_token"],
+                },
+            )
+            try:
+                with urlopen(request) as response:
+                    print(response.status, line.strip()[:80])
+            except HTTPError as err:
+                print(err.code, line.strip()[:80])
+
+
+if __name__ == "__main__":
+    post_updates(sys.argv[1])